@@ -33,10 +33,23 @@ class Simulation(object):
     def __init__(self,
                  config,
                  logfile='logs/core.log',
-                 logging_level=False):
+                 logging_level=False,
+                 engine='pipelined',
+                 api=None):
         """
+        Engine names the processor implementation: `pipelined' is cycle
+        accurate, `functional' runs an instruction per cycle and
+        `threaded' runs an instruction per cycle from cached blocks. All
+        three give the same register and memory state.
+
+        Api names the implementation of the instructions' api calls
+        (see module.Api.apis). By default it is the one named by the
+        ISA's configuration.
+
         Raises:
             All exceptions must be caught by the client.
+            UnknownEngineException if the engine doesn't exist.
+            UnknownApiException if the api doesn't exist.
         """
 
         try:
@@ -80,7 +93,9 @@ class Simulation(object):
 
         del coordinator
 
-        self.api = Api.Sunray()
+        if api is None:
+            api = self.instructions.get_api()
+        self.api = Api.get_api(api)()
         self.api.open_log(self.logger)
 
         self.assembler = Assembler.Assembler(
@@ -88,7 +103,7 @@ class Simulation(object):
             memory=self.memory)
         self.assembler.open_log(self.logger)
 
-        self.cpu = Processor.Pipelined(
+        self.cpu = Processor.get_engine(engine)(
             registers=self.registers, memory=self.memory,
             api=self.api, instructions=self.instructions,
             pipeline=pipeline[0],
@@ -179,13 +194,25 @@ class Simulation(object):
         return expression
 
     def load(self, filename, client):
-        """Loads an asm program into the simulation"""
+        """Loads an asm program into the simulation.
+
+        Files ending .hex are read as Intel HEX and .bin as raw binary
+        images, which are copied into memory without assembly.
+        """
         if not self._authorized_client(client):
             self.log.buffer("blocked `load' call from unauthorized client `{0}'".format(client.__class__.__name__),
                             level.ERROR)
             return
         self.log.buffer("`load' called by `{0}'".format(client.__class__.__name__),
                        level.FINER)
+        if filename.endswith('.hex'):
+            (binary, offset) = self.memory.load_hex(filename, and_dump=True)
+            # Images have no assembly source: list the words instead.
+            return (binary, binary, offset)
+        if filename.endswith('.bin'):
+            (binary, offset) = self.memory.load_binary(filename,
+                                                       and_dump=True)
+            return (binary, binary, offset)
         file_object = open(filename, 'r')
         # We will collect assembly binary and offset data, mainly to print.
         (binary, assembly) = self.assembler.read_file(file_object)
@@ -202,17 +229,48 @@ class Simulation(object):
             return
         self.cpu.reset()
 
+    def checkpoint(self, client):
+        """Returns a checkpoint of the simulation to roll back to.
+
+        Memory is shared with the checkpoint until it is changed, so a
+        checkpoint can be taken before any step of a long program.
+        """
+        if not self._authorized_client(client):
+            self.log.buffer("blocked `checkpoint' call from unauthorized client `{0}'"
+                            .format(client.__class__.__name__),
+                            level.ERROR)
+            return
+        self.log.buffer("`checkpoint' called by `{0}'"
+                        .format(client.__class__.__name__), level.FINER)
+        return (self.cpu.checkpoint(), self._cycles)
+
+    def rollback(self, checkpoint, client):
+        """Returns the simulation to a checkpoint without re-running it"""
+        if not self._authorized_client(client):
+            self.log.buffer("blocked `rollback' call from unauthorized client `{0}'"
+                            .format(client.__class__.__name__),
+                            level.ERROR)
+            return
+        self.log.buffer("`rollback' called by `{0}'"
+                        .format(client.__class__.__name__), level.FINER)
+        (state, self._cycles) = checkpoint
+        self.cpu.rollback(state)
+
 #
 # Authorization
 #
 
-    def connect(self, client):
+    def connect(self, client, subscription=None):
         """Connects a client while ensuring it implements the correct
         interfaces.
 
         Only authorized clients are allowed to issue instructions.
         This is to protect against exceptions caused by incomplete
         clients.
+
+        A subscription (module.Interface.Subscription) chooses the
+        topics the client is updated with and how often. By default it
+        gets everything, every cycle.
         """
         if not hasattr(client, 'update'):
             sys.stderr.write("ERROR: failed to connect client `{0}': it does not implement `update'\n"
@@ -228,7 +286,7 @@ class Simulation(object):
         #we want the client to be an UpdateListener to the CPU to
         #receive its state changes.
         #
-        self.cpu.register(client)
+        self.cpu.register(client, subscription)
         self._clients.append(client)
         self.log.write("attached client `{0}'".format(client.__class__.__name__),
                       level.INFO)
@@ -299,18 +357,20 @@ class TestListener(Interface.UpdateListener):
         self.s = simulation
 
     def update(self, *args, **kwargs):
-        r=kwargs['registers']
+        #updates hold the registers changed since the last, by number,
+        #or every register when full is set; others hold none
+        r=kwargs.get('registers', {})
         if False == True:
             try:
                 print "{:-<80}".format('--Registers')
-                for i in r.values():
-                    if i>0 and i % 4 == 0:
+                for (j, i) in enumerate(sorted(r)):
+                    if j>0 and j % 4 == 0:
                         print ''
                     name = self.s.registers.get_number_name_mappings()[i]
                     print("{:>4}({:0>2}):{:.>10}"
                           .format(name[:4],
                                   i,
-                                  hex(r.values()[i])[2:].replace('L', ''))),
+                                  hex(r[i])[2:].replace('L', ''))),
                 print "\n{:-<80}".format('')
             except:
                 pass
@@ -21,6 +21,9 @@ from lib.Functions import binary as bin
 class RegisterReferenceException(Exception):
     pass
 
+class UnknownApiException(Exception):
+    pass
+
 class BaseApi(LoggerClient):
     """Base class which provides the necessary storage and initialization
     for derrived Api implementations
@@ -56,21 +59,79 @@ class BaseApi(LoggerClient):
             (Usually within __init__ of the CPU.)
         """
 
+        self.settle()
         self._register = cpu.get_registers()
         self._memory   = cpu.get_memory()
         return self
 
+    def settle(self):
+        """Brings the registers up to date with any work the api has
+        deferred. The cpu calls this before the registers are read or
+        written by anything but the api.
+        """
+        pass
+
 
 class Sunray(BaseApi):
     """An API implementation which primarily supports the MIPS32 ISA."""
 
+    # Bits set by setBitInRegister are not worked into the register
+    # straight away: most are set again before anything reads them, as
+    # the condition flags of 808x ISAs are. The number of the register
+    # with bits deferred is kept, with its size and masks of the bits to
+    # set on and off, until the api next reads or writes the register or
+    # is settled. Calls which don't find their registers through
+    # _decode_register_reference settle whatever is deferred first.
+    _deferred      = None
+    _deferred_size = 0
+    _deferred_on   = 0
+    _deferred_off  = 0
+
+    def settle(self):
+        number = self._deferred
+        if number is not None:
+            self._deferred = None
+            value = self._register.get_value(number)
+            self._register.set_value(
+                number, (value | self._deferred_on) & ~self._deferred_off)
+
+    def _defer_bit(self, number, index, value):
+        # Records a bit set in a register instead of setting it. Only
+        # values which fit the register are deferred, so the bit is in
+        # the same place however the others are set. Returns False if
+        # the bit has to be set now.
+        if self._deferred != number:
+            self.settle()
+            register = self._register
+            current = register.get_value(number)
+            if (current is None or current & ~register.get_mask(number)
+                or number == register.get_pc()):
+                return False
+            self._deferred_size = register.get_size(number)
+            self._deferred_on   = 0
+            self._deferred_off  = 0
+        if value not in ('0', '1') or not 0 <= index < self._deferred_size:
+            self.settle()
+            return False
+        bit = 1 << (self._deferred_size - 1 - index)
+        if value == '1':
+            self._deferred_on  = self._deferred_on | bit
+            self._deferred_off = self._deferred_off & ~bit
+        else:
+            self._deferred_off = self._deferred_off | bit
+            self._deferred_on  = self._deferred_on & ~bit
+        self._deferred = number
+        return True
+
     def _decode_register_reference(self, value, instruction_decoded):
         try:
             # Assume we are looking at an instruction that has
             # a register number encoded in some field at index
-            value = int(instruction_decoded[value], 2)
+            value = instruction_decoded[value]
         except: pass
         # Assume it is an integer value
+        if value == self._deferred:
+            self.settle()
         return value
 
     def addRegisters(self, args, instruction_decoded, **named_args):
@@ -145,7 +206,7 @@ class Sunray(BaseApi):
         a = self._decode_register_reference(args[0], instruction_decoded)
         b = self._decode_register_reference(args[1], instruction_decoded)
         # This will be a signed immediate value.
-        c = int(instruction_decoded[args[2]], 2, signed=True)
+        c = instruction_decoded.signed[args[2]]
         self.log.buffer('args 0:{0}, 1:{1}, 2:{2}'.format(a, b, c),
                         level.FINEST)
         for operand in [a, b]:
@@ -187,9 +248,10 @@ class Sunray(BaseApi):
             RegisterReferenceException
         """
         self.log.buffer('subRegisters called', level.FINER)
-        a = int(instruction_decoded[args[0]], 2)
-        b = int(instruction_decoded[args[1]], 2)
-        c = int(instruction_decoded[args[2]], 2)
+        self.settle()
+        a = instruction_decoded[args[0]]
+        b = instruction_decoded[args[1]]
+        c = instruction_decoded[args[2]]
         self.log.buffer('args 0:{0}, 1:{1}, 2:{2}'.format(a,b,c), level.FINEST)
         for operand in [a, b, c]:
             if operand not in self._register.keys():
@@ -225,7 +287,7 @@ class Sunray(BaseApi):
         b = self._decode_register_reference(args[1], instruction_decoded)
         # This will be a signed immediate value.
         try:
-            c = int(instruction_decoded[args[2]], 2, signed=True)
+            c = instruction_decoded.signed[args[2]]
         except:
             c = args[2]
         self.log.buffer('args 0:{0}, 1:{1}, 2:{2}'.format(a, b, c), level.FINEST)
@@ -246,12 +308,13 @@ class Sunray(BaseApi):
 
     def copyRegister(self, args, instruction_decoded, **named_args):
         self.log.buffer('copyRegister called', level.FINER)
+        self.settle()
         if args[0] in instruction_decoded.keys():
-            a = int(instruction_decoded[args[0]], 2)
+            a = instruction_decoded[args[0]]
         else:
             a = args[0]
         if args[1] in instruction_decoded.keys():
-            b = int(instruction_decoded[args[1]], 2)
+            b = instruction_decoded[args[1]]
         else:
             b = args[1]
         #a = args[0]
@@ -281,12 +344,13 @@ class Sunray(BaseApi):
             RegisterReferenceException
         """
         self.log.buffer('mulRegisters called', level.FINER)
+        self.settle()
         try:
-            a = int(instruction_decoded[args[0]], 2)
+            a = instruction_decoded[args[0]]
         except:
             a = args[0]
-        b = int(instruction_decoded[args[1]], 2)
-        c = int(instruction_decoded[args[2]], 2)
+        b = instruction_decoded[args[1]]
+        c = instruction_decoded[args[2]]
         self.log.buffer('args 0:{:}, 1:{:}, 2:{:}'.format(a,b,c), level.FINEST)
         for operand in [b, c]:
             if operand not in self._register.keys():
@@ -318,12 +382,13 @@ class Sunray(BaseApi):
             RegisterReferenceException
         """
         self.log.buffer('divRegisters called', level.FINER)
+        self.settle()
         try:
-            a = int(instruction_decoded[args[0]], 2)
+            a = instruction_decoded[args[0]]
         except:
             a = args[0]
-        b = int(instruction_decoded[args[1]], 2)
-        c = int(instruction_decoded[args[2]], 2)
+        b = instruction_decoded[args[1]]
+        c = instruction_decoded[args[2]]
         self.log.buffer('args 0:{:}, 1:{:}, 2:{:}'.format(a,b,c), level.FINEST)
         if self._register.get_value(c) == 0:
             raise ArithmeticError
@@ -357,12 +422,13 @@ class Sunray(BaseApi):
             RegisterReferenceException
         """
         self.log.buffer('remRegisters called', level.FINER)
+        self.settle()
         try:
-            a = int(instruction_decoded[args[0]], 2)
+            a = instruction_decoded[args[0]]
         except:
             a = args[0]
-        b = int(instruction_decoded[args[1]], 2)
-        c = int(instruction_decoded[args[2]], 2)
+        b = instruction_decoded[args[1]]
+        c = instruction_decoded[args[2]]
         self.log.buffer('args 0:{:}, 1:{:}, 2:{:}'.format(a,b,c), level.FINEST)
         if self._register.get_value(c) == 0:
             raise ArithmeticError
@@ -390,12 +456,13 @@ class Sunray(BaseApi):
             Always returns True
         """
         self.log.buffer('setRegister called', level.FINER)
+        self.settle()
         if args[0] in instruction_decoded.keys():
-            a = int(instruction_decoded[args[0]], 2)
+            a = instruction_decoded[args[0]]
         else:
             a = args[0]
         if args[1] in instruction_decoded.keys():
-            b = int(instruction_decoded[args[1]], 2)
+            b = instruction_decoded[args[1]]
         else:
             b = args[1]
         self.log.buffer('args 0:{0}, 1:{1}'.format(a,b), level.FINEST)
@@ -425,6 +492,10 @@ class Sunray(BaseApi):
             If the call does not contain a '0' or '1' value in the `value'
             field, the result of this call is undefined.
 
+            The bit is not set straight away: it is recorded and worked
+            into the register when the api next reads or writes it, or
+            when the api is settled.
+
         Exceptions:
             This call has undefined behaviour and may not handle exceptions
             raised in the event of error.
@@ -438,6 +509,9 @@ class Sunray(BaseApi):
         c = str(args[2])
         self.log.buffer('args 0:{:}, 1:{:}, 2:{:}'.format(a, b, c), level.FINEST)
 
+        if self._defer_bit(a, b, c):
+            return True
+
         a_size = self._register.get_size(a)
 
         value = list(bin(self._register.get_value(a), a_size)[2:])
@@ -463,9 +537,10 @@ class Sunray(BaseApi):
             Always returns True
         """
         self.log.buffer('loadWord32 called', level.FINER)
-        a = int(instruction_decoded[args[0]], 2)
-        b = int(instruction_decoded[args[1]], 2)
-        c = int(instruction_decoded[args[2]], 2)
+        self.settle()
+        a = instruction_decoded[args[0]]
+        b = instruction_decoded[args[1]]
+        c = instruction_decoded[args[2]]
         self.log.buffer('args 0:{:}, 1:{:}, 2:{:}'.format(a,b,c), level.FINEST)
         offset=int(c)+self._register.get_value(int(b))
         word = self._memory.get_word(offset, 32)
@@ -490,9 +565,10 @@ class Sunray(BaseApi):
             Always returns True
         """
         self.log.buffer('storeWord32 called', level.FINER)
-        a = int(instruction_decoded[args[0]], 2)
-        b = int(instruction_decoded[args[1]], 2)
-        c = int(instruction_decoded[args[2]], 2)
+        self.settle()
+        a = instruction_decoded[args[0]]
+        b = instruction_decoded[args[1]]
+        c = instruction_decoded[args[2]]
         self.log.buffer('args 0:{:}, 1:{:}, 2:{:}'.format(a,b,c), level.FINEST)
         value=self._register.get_value(int(a))
         offset=int(c)+self._register.get_value(int(b))
@@ -573,8 +649,9 @@ class Sunray(BaseApi):
         Returns true if a is less than b.
         """
         self.log.buffer('testLess called', level.FINER)
-        a = int(instruction_decoded[args[0]], 2)
-        b = int(instruction_decoded[args[1]], 2)
+        self.settle()
+        a = instruction_decoded[args[0]]
+        b = instruction_decoded[args[1]]
         self.log.buffer('args 0:{0}, 1:{1}'.format(a,b), level.FINEST)
         self.log.buffer('returning {0}'.format(self._register.get_value(a) < self._register.get_value(b)),
                         level.FINEST)
@@ -601,8 +678,9 @@ class Sunray(BaseApi):
         Returns true if a > b.
         """
         self.log.buffer('testGreater called', level.FINER)
-        a = int(instruction_decoded[args[0]], 2)
-        b = int(instruction_decoded[args[1]], 2)
+        self.settle()
+        a = instruction_decoded[args[0]]
+        b = instruction_decoded[args[1]]
         self.log.buffer('args 0:{0}, 1:{1}'.format(a,b), level.FINEST)
         self.log.buffer('returning {0}'
                         .format(self._register.get_value(a) > self._register.get_value(b)),
@@ -615,8 +693,9 @@ class Sunray(BaseApi):
         Returns true if a >= b.
         """
         self.log.buffer('testGreaterOrEqual called', level.FINER)
-        a = int(instruction_decoded[args[0]], 2)
-        b = int(instruction_decoded[args[1]], 2)
+        self.settle()
+        a = instruction_decoded[args[0]]
+        b = instruction_decoded[args[1]]
         self.log.buffer('args 0:{0}, 1:{1}'.format(a,b), level.FINEST)
         self.log.buffer('returning {0}'.format(self._register.get_value(a) >= self._register.get_value(b)),
                         level.FINEST)
@@ -686,6 +765,7 @@ class Sunray(BaseApi):
         Returns:
             True or False
         """
+        self.settle()
         a = args[0]
         b = args[1]
 
@@ -744,7 +824,8 @@ class Sunray(BaseApi):
         Returns True
         """
         self.log.buffer('branchAbsolute called', level.FINER)
-        a = int(instruction_decoded[args[0]], 2)
+        self.settle()
+        a = instruction_decoded[args[0]]
         self.log.buffer('args 0:{:}'.format(a), level.FINEST)
         # add branch delay
         if len(args) > 1:
@@ -766,7 +847,7 @@ class Sunray(BaseApi):
         Returns True
         """
         self.log.buffer('branchRelative called', level.FINER)
-        a = int(instruction_decoded[args[0]], 2, signed=True)
+        a = instruction_decoded.signed[args[0]]
         self.log.buffer('args 0:{0}'.format(a), level.FINEST)
         # add branch delay
         if len(args) > 1:
@@ -788,7 +869,7 @@ class Sunray(BaseApi):
     def incrementPc(self, args, instruction_decoded, **named_args):
         """args:list -> True"""
         self.log.buffer('incrementPc called', level.FINER)
-        a = int(instruction_decoded[args[0]], 2)
+        a = instruction_decoded[args[0]]
         pc=self._register.get_pc()
         value=self._register.get_value(pc)+a
         self._register.set_value(pc, value)
@@ -802,6 +883,7 @@ class Sunray(BaseApi):
     def systemCall(self, args, instruction_decoded, **named_args):
         """args:list -> True"""
         self.log.buffer('systemCall called', level.FINER)
+        self.settle()
         system_call = SystemCall()
         try:
             if args[0][:3] == 'DIR':
@@ -813,3 +895,183 @@ class Sunray(BaseApi):
         self.log.buffer('args 0:{0}'.format(a), level.FINEST)
         system_call.service(result)
         return True
+
+
+class MaskedSunray(Sunray):
+    """An API implementation with the semantics of Sunray, whose
+    arithmetic works on integers rather than binary strings.
+
+    Values are read as two's complement with a sign bit the width of
+    the register, or of the value if it is wider, just as Sunray reads
+    them. Negative results are brought into the width of the register
+    they are stored in; positive results are stored as they are.
+    """
+
+    def _signed(self, value, size):
+        # Reads a register value as two's complement.
+        if value < 0:
+            value = value + (1 << size)
+        sign = 1 << (max(size, value.bit_length()) - 1)
+        return (value ^ sign) - sign
+
+    def _unsigned(self, value, size):
+        # Brings a negative result into a register of the size.
+        if value < 0:
+            return value + (1 << size)
+        return value
+
+    def _bit(self, value, size, index):
+        # Returns a mask of the bit at index in an unsigned value,
+        # counting from the most significant bit of the register.
+        return 1 << (max(size, value.bit_length()) - 1 - index)
+
+    def addRegisters(self, args, instruction_decoded, **named_args):
+        """Adds two registers and stores the result in a third.
+
+        See Sunray.addRegisters.
+        """
+        self.log.buffer('addRegisters called', level.FINER)
+        a = self._decode_register_reference(args[0], instruction_decoded)
+        b = self._decode_register_reference(args[1], instruction_decoded)
+        c = self._decode_register_reference(args[2], instruction_decoded)
+        self.log.buffer('args 0:{0}, 1:{1}, 2:{2}'.format(a,b,c),
+                        level.FINEST)
+        register = self._register
+        for operand in [a, b, c]:
+            if operand not in register.keys():
+                raise RegisterReferenceException
+        result = (self._signed(register.get_value(b), register.get_size(b))
+                  + self._signed(register.get_value(c), register.get_size(c)))
+        result = self._unsigned(result, register.get_size(a))
+        self.log.buffer('result is {0}'.format(result), level.FINEST)
+        register.set_value(a, result)
+        return True
+
+    def addImmediate(self, args, instruction_decoded, **named_args):
+        """Adds a register to an immediate value and stores the
+        result in a second register.
+
+        See Sunray.addImmediate.
+        """
+        self.log.buffer('addImmediate called', level.FINER)
+        a = self._decode_register_reference(args[0], instruction_decoded)
+        b = self._decode_register_reference(args[1], instruction_decoded)
+        # This will be a signed immediate value.
+        c = instruction_decoded.signed[args[2]]
+        self.log.buffer('args 0:{0}, 1:{1}, 2:{2}'.format(a, b, c),
+                        level.FINEST)
+        register = self._register
+        for operand in [a, b]:
+            if operand not in register.keys():
+                raise RegisterReferenceException
+        result = self._signed(register.get_value(b), register.get_size(b)) + c
+        result = self._unsigned(result, register.get_size(a))
+        self.log.buffer('result is {0}'.format(result), level.FINEST)
+        register.set_value(a, result)
+        return True
+
+    def subImmediate(self, args, instruction_decoded, **named_args):
+        """Subtracts an immediate value from a registers and stores the
+        result in a second register.
+
+        See Sunray.subImmediate.
+        """
+        self.log.buffer('subImmediate called', level.FINER)
+        a = self._decode_register_reference(args[0], instruction_decoded)
+        b = self._decode_register_reference(args[1], instruction_decoded)
+        # This will be a signed immediate value.
+        try:
+            c = instruction_decoded.signed[args[2]]
+        except:
+            c = args[2]
+        self.log.buffer('args 0:{0}, 1:{1}, 2:{2}'.format(a, b, c), level.FINEST)
+        register = self._register
+        for operand in [a, b]:
+            if operand not in register.keys():
+                raise RegisterReferenceException
+        result = self._signed(register.get_value(b), register.get_size(b)) - c
+        result = self._unsigned(result, register.get_size(a))
+        self.log.buffer('result is {0}'.format(result), level.FINEST)
+        register.set_value(a, result)
+        return True
+
+    def setBitInRegister(self, args, instruction_decoded, **named_args):
+        """Sets one bit in a register value to on or off.
+
+        See Sunray.setBitInRegister.
+        """
+        self.log.buffer('setBitInRegister called', level.FINER)
+        a = args[0]
+        b = int(args[1])
+        c = str(args[2])
+        self.log.buffer('args 0:{:}, 1:{:}, 2:{:}'.format(a, b, c), level.FINEST)
+
+        if self._defer_bit(a, b, c):
+            return True
+
+        size  = self._register.get_size(a)
+        value = self._unsigned(self._register.get_value(a), size)
+        bit   = self._bit(value, size, b)
+        if c == '1':
+            value = value | bit
+        else:
+            value = value & ~bit
+        self._register.set_value(a, value)
+
+        return True
+
+    def testBitIsOn(self, args, instruction_decoded, **named_args):
+        """Returns true if register has bit_n set to 0b1
+
+        See Sunray.testBitIsOn.
+        """
+        self.settle()
+        a = args[0]
+        b = args[1]
+
+        size  = self._register.get_size(a)
+        value = self._unsigned(self._register.get_value(a), size)
+
+        return value & self._bit(value, size, b) != 0
+
+    def testBitIsOff(self, args, instruction_decoded, **named_args):
+        """Returns true if register has bit_n set to 0b0
+
+        See Sunray.testBitIsOff.
+        """
+        a = self._decode_register_reference(args[0], instruction_decoded)
+        b = args[1]
+
+        size  = self._register.get_size(a)
+        value = self._unsigned(self._register.get_value(a), size)
+
+        return value & self._bit(value, size, b) == 0
+
+
+# Api implementations which core.Simulation can build, by the name an
+# ISA gives in the api attribute of its instructions.xml.
+apis = {'sunray'        : Sunray,
+        'masked-sunray' : MaskedSunray}
+
+def register_api(name, api):
+    """(name:str, api:class) -> ...
+
+    Makes an api implementation available by name, replacing any
+    registered under the name before.
+    """
+    apis[name] = api
+
+def get_api(name):
+    """name:str -> class
+
+    Returns the api class registered under a name.
+
+    Raises:
+        UnknownApiException if there is no such api.
+    """
+    try:
+        return apis[name]
+    except KeyError:
+        raise UnknownApiException(
+            "no such api `{:}', expected one of: {:}"
+            .format(name, ", ".join(sorted(apis))))
@@ -12,7 +12,7 @@
 
 import re
 
-from copy      import deepcopy
+from numbers   import Integral
 from Logger    import AssemblerLogger
 from Interface import *
 
@@ -43,21 +43,20 @@ class BaseAssembler(LoggerClient):
         """Read a line or lines of input and return a list of instructions.
 
         Description:
-           [lines:str]:list -> [instructions:str]:list
+           [lines:str]:list -> [instructions:int]:list
 
         Purpose:
-            Reads lines of assembly in the form of a list and returns a
-            binary listing. Preprocessing and linking is done.
+            Reads lines of assembly in the form of a list and returns
+            the machine instructions. Preprocessing and linking is done.
 
         Restrictions:
-            Behaviour is undefined if argument is not of type <str>,
-            representing a binary number.
+            Behaviour is undefined if argument is not of type <str>.
 
         Exceptions:
             N/A
 
         Returns:
-            A list of binary instructions.
+            A list of encoded instructions, one per word.
         """
         pass
     def read_file(self, lines):
@@ -68,8 +67,9 @@ class BaseAssembler(LoggerClient):
                 ([instructions:int]:list, [original:str]:list)
 
         Purpose:
-            Opens a read an assembly file to return a binary listing.
-            All the necessary preprocessing and linking will be done.
+            Opens a read an assembly file to return the machine
+            instructions. All the necessary preprocessing and linking
+            will be done.
 
         Restrictions:
             See exceptions.
@@ -78,7 +78,7 @@ class BaseAssembler(LoggerClient):
             Exception
 
         Returns:
-            A tuple, element 0 is a list of binary encoded instructions,
+            A tuple, element 0 is a list of encoded instructions,
             element 1 is the original listing (processed).
         """
         pass
@@ -86,27 +86,116 @@ class BaseAssembler(LoggerClient):
         """Converts a list of binary instructions to an integer list.
 
         Description:
-            [lines:str]:list -> [instructions:int]:list
+            [lines:str|int]:list -> [instructions:int]:list
 
         Purpose:
             Before attempting to load a program that has been through
             the assembler, it should be converted for use in the
-            simulation.
+            simulation. The assembler already returns integers, which
+            are kept as they are; binary strings are converted.
 
         Restrictions:
-            Behaviour is undefined if arguments are not of type <str>,
-            representing a binary number.
+            Behaviour is undefined if arguments are not integers or of
+            type <str>, representing a binary number.
 
         Exceptions:
-            N/A
+            DataConversionFromUnknownType
 
         Returns:
             A list of integers.
         """
         pass
+    def listing(self, instructions):
+        """Formats encoded instructions for display.
+
+        Description:
+            [instructions:int]:list -> [instructions:str]:list
+
+        Returns:
+            A list of binary strings, each as wide as a word of the ISA.
+        """
+        pass
     def get_jump_table():
         pass
 
+class Lexer(object):
+    """Reads lines of assembly written in the syntax of an ISA.
+
+    The ISA's patterns are compiled once, when the lexer is made: the
+    comment, label and reference patterns of the assembler, and the
+    expression of every instruction.
+    """
+
+    def __init__(self, instructions):
+        syntax = instructions.get_assembly_syntax()
+        self._comment   = re.compile(syntax['comment'])
+        self._label     = re.compile(syntax['label'])
+        self._reference = re.compile(syntax['reference'])
+        self._mnemonic  = re.compile('\w+')
+        # Instruction expressions, anchored to match whole lines and
+        # unanchored to find the groups holding labels.
+        self._expressions = {}
+        self._searches    = {}
+        for (instruction, syntax) in instructions.get_syntax().items():
+            pattern = syntax['expression']
+            self._expressions[instruction] = re.compile('^' + pattern + '$')
+            self._searches[instruction]    = re.compile(pattern)
+
+    def clean(self, line):
+        """line:str -> line:str
+
+        Returns a line without its comment, with whitespace runs
+        reduced to single spaces and none at either end.
+        """
+        return ' '.join(self._comment.sub('', line).split())
+
+    def is_label(self, line):
+        """line:str -> bool
+
+        Returns True if the first label on a line is all of it.
+        """
+        match = self._label.search(line)
+        return match is not None and match.group(0) == line
+
+    def split_label(self, line):
+        """line:str -> (reference:str, line:str)
+
+        Returns the name of the first label on a line, or None if it
+        has none, and the line with its labels removed.
+
+        Raises:
+            AttributeError if a label has no reference.
+        """
+        match = self._label.search(line)
+        if match is None:
+            return (None, line)
+        reference = self._reference.search(match.group())
+        return (reference.group(1), self._label.sub('', line))
+
+    def mnemonic(self, line):
+        """line:str -> str
+
+        Returns the word an instruction begins with.
+        """
+        return self._mnemonic.match(line).group()
+
+    def match(self, instruction, line):
+        """(instruction:str, line:str) -> match:object
+
+        Returns the match of an instruction's expression with all of a
+        line, or None.
+        """
+        return self._expressions[instruction].match(line)
+
+    def search(self, instruction, line):
+        """(instruction:str, line:str) -> match:object
+
+        Returns the first match of an instruction's expression in a
+        line, or None.
+        """
+        return self._searches[instruction].search(line)
+
+
 class Assembler(BaseAssembler):
     # TODO: Try and phase out these declarations and rely on the values
     # given in __init__. (2011-08-18)
@@ -117,11 +206,6 @@ class Assembler(BaseAssembler):
     _text_offset     = None # Location to load the program.
     _isa_size        = None # Used to calculate instruction length.
 
-    _instruction_syntax={}
-    _format_properties={}
-    _format_mappings={}
-    _registers={}
-
     def __init__(self, instructions, registers, memory):
         # TODO: Clearer to access the ISA directly, rather than grabbing
         # all its values at once. (2011-08-28)
@@ -132,6 +216,7 @@ class Assembler(BaseAssembler):
         self._instruction_values = instructions.get_values()
         self._format_properties  = instructions.get_format_bit_ranges()
         self._format_mappings    = instructions.get_instruction_to_format_map()
+        self._format_cycles      = instructions.get_format_cycles()
         self._comment_pattern    = instructions.get_assembly_syntax()['comment']
         self._label_pattern      = instructions.get_assembly_syntax()['label']
         self._label_reference    = instructions.get_assembly_syntax()['reference']
@@ -140,6 +225,11 @@ class Assembler(BaseAssembler):
         self._isa_size           = instructions.getSize()
         self._registers          = registers.get_register_mappings()
 
+        # Patterns compiled from the ISA, and how to encode each
+        # instruction, worked out when it is first encoded
+        self._lexer     = Lexer(instructions)
+        self._encodings = {}
+
         # Dynamic data
         self._isa = instructions
         self._jump_table   = {}
@@ -172,13 +262,18 @@ class Assembler(BaseAssembler):
     def convert(self, lines):
         try:
             for i in range(len(lines)):
-                lines[i] = int(lines[i], 2)
+                if not isinstance(lines[i], Integral):
+                    lines[i] = int(lines[i], 2)
         except:
             raise DataConversionFromUnknownType(
                 'Tried to convert from unknown type: {0} {1}'
                 .format(lines[i], type(lines[i])))
         return lines
 
+    def listing(self, instructions):
+        return [bin(instruction, self._isa_size)[2:]
+                for instruction in instructions]
+
     def get_jump_table(self):
         return self._jump_table
 
@@ -186,7 +281,7 @@ class Assembler(BaseAssembler):
 # Worker functions
 #
     def _read(self, lines):
-        """[lines:str]:list -> [instructions:str]:list"""
+        """[lines:str]:list -> [instructions:int]:list"""
         lines=self._preprocess(lines)
         lines=self._link(lines)
         lines=self._encode(lines)
@@ -200,6 +295,10 @@ class Assembler(BaseAssembler):
         labels in the assembly are indexed and references to them
         will be replaced in the second pass.
 
+        Each line is read once. A line holding only a label is joined
+        to the line after it, so labels are always associated with the
+        correct line.
+
         +------------------------------------------------------+
         | Validation                                           |
         +------------------------------------------------------+
@@ -208,82 +307,73 @@ class Assembler(BaseAssembler):
         """
 
         self.log.buffer("entering preprocessor", level.FINER)
+        lexer = self._lexer
         #remove all newlines from the list
-        lines = ''.join(lines)
-        try:
-            lines = re.split('\n', lines)
-        except:
-            self.log.buffer("file format is irregular: expecting newlines, got none",
-                            level.ERROR)
-            pass
-        #we don't want comments, blank lines or whitespace
-        for i in range(len(lines)):
-            lines[i] = re.sub(self._comment_pattern, '' , lines[i])
-            lines[i] = re.sub('\s+', ' ', lines[i])
-            lines[i] = lines[i].strip()
-        lines = [line for line in lines if line != '']
-
-        #we need to further clean the table so labels are always
-        #associated with the correct line
-        i = 0
-        while i < len(lines):
-            if re.search(self._label_pattern, lines[i]):
-                match = re.search(self._label_pattern, lines[i])
-                if match.group(0) == lines[i] and i+1 < len(lines):
-                    #grab the next line to concaternate
-                    cat = lines.pop(i+1)
-                    lines[i] = lines[i] + ' ' + cat
-                    i = i+1
-            i = i+1
+        lines = ''.join(lines).split('\n')
 
         # Here we will build a table mapping labels to memory locations.
         self._jump_table.clear()
 
-
+        output = []
+        label  = None
+        offset = 0
+        line   = ''
         try:
             # FIX: This code might me dicey. Throws a key exception on
             # very malformed input. Why? (2011-08-30)
             # Not a big problem, only affects syntax errors.
-            offset = 0
-            for i in range(len(lines)):
-                # Here we look for a label.
-                if re.search(self._label_pattern, lines[i]):
-                    match = re.search(self._label_pattern, lines[i])
-                    # Here we define the reference for this label.
-                    # This will be its lookup name in the table.
-                    reference = re.search(self._label_reference, match.group())
-                    self._jump_table[reference.group(1)] = offset
+            for line in lines + [None]:
+                if line is None:
+                    # A label on the last line stands alone.
+                    if label is None:
+                        break
+                    (line, label) = (label, None)
+                else:
+                    #we don't want comments, blank lines or whitespace
+                    line = lexer.clean(line)
+                    if line == '':
+                        continue
+                    if label is not None:
+                        #concaternate the label held from the line before
+                        (line, label) = (label + ' ' + line, None)
+                    elif lexer.is_label(line):
+                        label = line
+                        continue
+
+                # Here we look for a label, and define the reference
+                # which will be its lookup name in the table. Labels
+                # are then removed from the original.
+                (reference, line) = lexer.split_label(line)
+                if reference is not None:
+                    self._jump_table[reference] = offset
                     self.log.buffer("mapped label `{0}' to {1}"
-                                    .format(reference.group(1), offset),
+                                    .format(reference, offset),
                                     level.FINER)
-                    # Finally, remove labels from the original
-                    lines[i] = re.sub(self._label_pattern,'',lines[i])
 
                 # We will calculate any aditional offset required in the case
                 # of multi-part instructions.
-                instruction  = lines[i].split()[0]
+                instruction  = line.split()[0]
                 format_name  = self._format_mappings[instruction]
-                fetch_cycles = self._isa.get_format_cycles()[format_name]
-                offset = offset + fetch_cycles
+                offset = offset + self._format_cycles[format_name]
 
                 # We don't want unnecessary whitespace
-                lines[i] = lines[i].strip()
-                self.log.buffer("processed  {0}".format(lines[i]), level.FINE)
+                line = line.strip()
+                output.append(line)
+                self.log.buffer("processed  {0}".format(line), level.FINE)
         except:
                 raise BadInstructionOrSyntax(
                     "{:} on line {:}:\n{:}"
-                    .format(BAD, i+1, lines[i]))
+                    .format(BAD, len(output)+1, line))
 
-        lines = [line for line in lines if line != '']
         self.log.buffer("leaving preprocessor", level.FINER)
-        return lines
+        return output
 
     def _link(self, lines):
         """Transforms the program replacing branch identifiers with
         computed addresses that reference labels in the code.
 
         Description:
-            [lines:str]:list -> [lines:str]:list
+            [lines:str]:list -> [(instruction:str, match:object)]:list
             Ensures all branch identifiers are valid (ie. corresponding
             labels were found in preprocessing) and replaces them with
             interim hexadecimal addresses. These hex addresses will be
@@ -292,84 +382,127 @@ class Assembler(BaseAssembler):
         Purpose:
             preprocessing -> [linking] -> encoding
 
+            Each line is matched against the syntax of its instruction
+            here, once, and the match is handed on to the encoder.
+
         Restrictions:
             N/A
 
         Exceptions:
-            N/A
+            Raises:
+                BadInstructionOrSyntax
 
         Returns:
-            A version of the program having all labels replaced with memory
-            references.
+            Each instruction of the program, with the match of its
+            syntax once all labels are replaced with memory references.
+            The linked program is kept as the listing.
          """
 
         # TODO: Linker needs to handle absolute addresses in multi-part
         # instructions. (2011-08-28)
         self.log.buffer("entering linker", level.FINER)
+        lexer = self._lexer
 
-        # We will store the return data in output.
-        output=[]
+        # We will store the return data in output, and the program in
+        # listing.
+        output  = []
+        listing = []
         for i in range(len(lines)):
-            # First, check the instruction is valid. If we try to operate
-            # with badly formed instructions at this point we will raise
-            # an exception in the re module.
-            instruction = lines[i].split()[0]
+            # First, check the instruction is valid.
+            line = lines[i]
+            instruction = line.split()[0]
             if instruction in self._format_mappings:
-                syntax     = self._instruction_syntax[instruction]
-                expression = '^' + syntax['expression'] + '$'
+                match = lexer.match(instruction, line)
             else:
+                match = None
+            if not match:
                 raise BadInstructionOrSyntax(
                     "{:} on line {:}:\n{:}"
-                    .format(BAD, i+1, lines[i]))
-
-            # We should have this data from the previous stage, or have
-            # thrown an error.
-            match = re.search(expression, lines[i])
-            if match:
-                key = re.match('\w+', lines[i]).group()
-                if key in self._label_replacements:
-                    group = self._label_replacements[key][1]
-                    mode  = self._label_replacements[key][2]
-
-                    pattern = self._instruction_syntax[key]['expression']
-                    match = re.search(pattern, lines[i])
-                    label = match.group(group)
-
-                    # Calculate either absolute or relative addresses based on
-                    # configuration file/API options.
-                    try:
-                        if mode == 'absolute':
-                            base = self._text_offset
-                            offset = self._jump_table[label]
-                            offset = hex(base + (offset * self._word_spacing),
-                                         self._isa_size/4)
-                        elif mode == 'relative':
-                            offset = str(self._jump_table[label] - i)
-                    # Finally, we can replace the label.
-                        lines[i] = lines[i].replace(label, offset)
-                        self.log.buffer("replaced identifier `{:}'"
-                                        "with {:}".format(
-                                        label, offset), level.FINER)
-                    except:
-                        raise BadInstructionOrSyntax(
-                            "{:} on line {:}: Label not found.\n{:}"
-                            .format(BAD, i+1, lines[i]))
-                output.append(lines[i])
-            else:
-                raise BadInstructionOrSyntax(
-                    "{:} on line {:}:\n{:}"
-                    .format(BAD, i+1, lines[i]))
+                    .format(BAD, i+1, line))
+
+            key = lexer.mnemonic(line)
+            if key in self._label_replacements:
+                group = self._label_replacements[key][1]
+                mode  = self._label_replacements[key][2]
+
+                label = lexer.search(key, line).group(group)
+
+                # Calculate either absolute or relative addresses based on
+                # configuration file/API options.
+                try:
+                    if mode == 'absolute':
+                        base = self._text_offset
+                        offset = self._jump_table[label]
+                        offset = hex(base + (offset * self._word_spacing),
+                                     self._isa_size/4)
+                    elif mode == 'relative':
+                        offset = str(self._jump_table[label] - i)
+                # Finally, we can replace the label.
+                    line = line.replace(label, offset)
+                    self.log.buffer("replaced identifier `{:}'"
+                                    "with {:}".format(
+                                    label, offset), level.FINER)
+                except:
+                    raise BadInstructionOrSyntax(
+                        "{:} on line {:}: Label not found.\n{:}"
+                        .format(BAD, i+1, line))
+                match = lexer.match(instruction, line)
+                if not match:
+                    raise BadInstructionOrSyntax(
+                        "{:} on line {:}:\n{:}"
+                        .format(BAD, i+1, line))
+            output.append((instruction, match))
+            listing.append(line)
 
-        self._program = deepcopy(output)
+        self._program = listing
         self.log.buffer("leaving linker", level.FINER)
         return output
 
+    def _encoding(self, instruction):
+        """instruction:str -> (preset:int, [field]:list, cycles:int,
+                               length:int):tuple
+
+        Works out how to encode an instruction: the value of its preset
+        fields, where each symbol of its syntax goes, as (shift, mask)
+        in the instruction, and its length in words and bits.
+
+        A symbol is given as None if it is not encoded, because a preset
+        value or a later symbol fills the same field.
+        """
+        format_name = self._format_mappings[instruction]
+        bit_ranges  = self._format_properties[format_name]
+        cycles      = self._format_cycles[format_name]
+        length      = self._isa_size * cycles
+        def position(field):
+            (start, end) = bit_ranges[field]
+            return (length - end - 1, (1 << (end - start + 1)) - 1)
+
+        values = self._instruction_values[instruction]
+        preset = 0
+        for field in values:
+            (shift, mask) = position(field)
+            preset = preset | ((values[field] & mask) << shift)
+
+        symbols = [symbol[0] for symbol
+                   in self._instruction_syntax[instruction]['symbols']]
+        fields  = []
+        for i in range(len(symbols)):
+            field = symbols[i]
+            if field in values or field in symbols[i+1:]:
+                fields.append(None)
+            else:
+                fields.append(position(field))
+
+        encoding = (preset, fields, cycles, length)
+        self._encodings[instruction] = encoding
+        return encoding
+
     def _encode(self, lines):
         """Takes a list of assembly instructions (with decoded identifiers)
-        and returns a list of binary machine instructions.
+        and returns a list of machine instructions.
 
         Description:
-            [lines:str]:list -> [lines:str]:list
+            [(instruction:str, match:object)]:list -> [instructions:int]:list
 
             Once an assembly program has been through the linker and all
             the identifiers (label references) have been replaced with
@@ -380,144 +513,76 @@ class Assembler(BaseAssembler):
             Encodes assembly instructions as binary: the final step in
             converting an assembly program into machine code.
 
-            Encoding gurantees that instruction syntax is correct and
-            that identifiers and register references are valid.
+            Encoding gurantees that identifiers and register references
+            are valid. The linker has already matched the syntax.
+
+            Each field is shifted into place and ORed into an integer,
+            starting from the instruction's preset fields. Instructions
+            which span several words are split into them with shifts.
 
         Restrictions:
             The result of processing identifiers which have not been
-            converter is undefined.
+            converter is undefined. A field of w bits takes values from
+            -2**(w-1) to 2**w - 1, and negative values are encoded in
+            two's complement.
 
         Exceptions:
             Raises:
                 BadInstructionOrSyntax
 
         Returns:
-            A list of binary manchine instructions.
+            A list of machine instructions, one per word.
         """
 
         self.log.buffer("entering encoder", level.FINER)
-        # We will return output and use instruction_fields to build up
-        # each instruction.
-        output             = []
-        instruction_fields = {}
-        for line in lines:
-            #
-            # Here we will read the instruction on each line, try to fetch
-            # a regular expression for it, and split it into groups.
-            #
-            instruction = line.split()[0]
-            if instruction in self._format_mappings:
-                syntax     = self._instruction_syntax[instruction]
-                expression = '^' + syntax['expression'] + '$'
-                self.log.buffer("matching `{0}' instruction"
-                                .format(instruction), level.FINER)
-                match = re.search(expression, line)
-                if match:
-                    # Here we are looping over fields in the instruction
-                    # format and determining their values.
-                    for i in range(len(match.groups())):
-                        field = syntax['symbols'][i][0]
-                        value = match.groups()[i]
-
-                        # This block deals with the possibility that the
-                        # symbol is a hex number.
-                        if value not in self._registers:
-                            try:
-                                if value[:2] == '0x':
-                                    value = int(value, 16)
-                                elif value.endswith(self._hex_pattern):
-                                    value = value.replace(self._hex_pattern, '')
-                                    value = int(value, 16)
-                                else:
-                                    value=int(value)
-                            except:
-                                line = "`" + line + "'"
-                                raise BadInstructionOrSyntax(
-                                    "{:} on line {:}:Non-ref or digit.\n{:}"
-                                    .format(BAD, i+1, lines[i]))
-                        # We have identified the field. Log it...
-                        self.log.buffer("`{0}' is {1}"
-                                        .format(field, value), level.FINEST)
-                        # ...and add it to the instruction.
-                        instruction_fields[field] = value
-
-                    # This block adds the preset field values.
-                    values = self._instruction_values[instruction]
-                    for field in values:
-                        instruction_fields[field] = values[field]
-                        self.log.buffer("`{0}' is {1}"
-                                        .format(field, values[field]),
-                                        level.FINEST)
-
-                    #print("instruction: {:}".format(instruction_fields))
-
-
-                    # Here we binary-encode the instruction.
-                    format_name = self._format_mappings[instruction]
-                    fetch_cycles = self._isa.get_format_cycles()[format_name]
-                    instruction_length = self._isa_size * fetch_cycles
-                    # Creates a list of 0s which we can edit to match the
-                    # instruction.
-                    instruction_raw = instruction_length * '0'.split()
-                    for field in instruction_fields:
-                        start = self._format_properties[format_name][field][0]
-                        end   = self._format_properties[format_name][field][1]+1
-                        # If the value is a register reference, encode the
-                        # register number, otherwise encode literal.
-                        if instruction_fields[field] in self._registers:
-                            value = self._registers[instruction_fields[field]]
-                        else:
-                            value = instruction_fields[field]
-                        # Now insert the encoded field into the instruction.
-                        width = end - start
-                        value = bin(value, size = width)[2:]
-                        instruction_raw[start:end] = value
-                        self.log.buffer("{:}:{:} is {:}"
-                                        .format(start, end, value),
-                                        level.FINEST)
-
-                    # Finally convert the instruction from a list to a string.
-                    instruction_raw = "".join(instruction_raw)
-                    # Bon.
-                    self.log.buffer("encoded {0}".format(instruction_raw),
-                                    level.FINER)
-
-                    # Split the instruction if it spans multiple words.
-                    # eg. 8085 Direct Addressing uses three 8 bit parts
-                    # despite being an 8 bit ISA.
-                    self.log.buffer("splitting into {:}-bit chunks"
-                                    .format(self._isa_size),
-                                    level.FINER)
-                    start = 0
-                    end   = 1
-                    for i in range(len(instruction_raw)):
-                        if end % self._isa_size == 0:
-                            part = instruction_raw[start:end]
-                            # Log entry is indented for readability.
-                            self.log.buffer(
-                                "  split {:}".format(part),
-                             level.FINER)
-                            output.append(part)
-                            start = end
-                        end = end + 1
-                    #output.append(instruction_raw)
+        output    = []
+        registers = self._registers
+        size      = self._isa_size
+        word_mask = (1 << size) - 1
+        for (number, (instruction, match)) in enumerate(lines):
+            encoding = self._encodings.get(instruction)
+            if encoding is None:
+                encoding = self._encoding(instruction)
+            (code, fields, cycles, length) = encoding
+            # Here we are looping over fields in the instruction
+            # format and determining their values.
+            groups = match.groups()
+            for i in range(len(groups)):
+                value = groups[i]
+                # If the value is a register reference, encode the
+                # register number, otherwise encode literal, which may
+                # be a hex number.
+                if value in registers:
+                    value = registers[value]
                 else:
-                    raise BadInstructionOrSyntax(
-                        "{:} on line {:}:\n{:}"
-                        .format(BAD, i+1, lines[i]))
-            # TODO: Keep this block under review. Probably kept for a reason.
-            #(2011-08-18)
-            #elif instruction in self._special_instructions:
-                #
-                #we aren't dealing with specials yet
-                #this will probably come into play with assembler directives
-                #
-                #output.append(instruction)
-                #pass
-            else:
-                raise BadInstructionOrSyntax(
-                    "{:} on line {:}:\n{:}"
-                    .format(BAD, i+1, lines[i]))
-            instruction_fields.clear()
+                    try:
+                        if value[:2] == '0x':
+                            value = int(value, 16)
+                        elif value.endswith(self._hex_pattern):
+                            value = value.replace(self._hex_pattern, '')
+                            value = int(value, 16)
+                        else:
+                            value=int(value)
+                    except:
+                        raise BadInstructionOrSyntax(
+                            "{:} on line {:}:Non-ref or digit.\n{:}"
+                            .format(BAD, number+1, match.string))
+                if fields[i] is not None:
+                    (shift, mask) = fields[i]
+                    if not -((mask + 1) >> 1) <= value <= mask:
+                        raise BadInstructionOrSyntax(
+                            "{:} on line {:}: {:} does not fit its field.\n{:}"
+                            .format(BAD, number+1, groups[i], match.string))
+                    code = code | ((value & mask) << shift)
+
+            self.log.buffer("encoded `{:}' as {:}"
+                            .format(instruction, hex(code, length/4)),
+                            level.FINER)
+
+            # Split the instruction if it spans multiple words.
+            # eg. 8085 Direct Addressing uses three 8 bit parts
+            # despite being an 8 bit ISA.
+            for shift in range(length - size, -1, -size):
+                output.append((code >> shift) & word_mask)
         self.log.buffer("leaving encoder", level.FINER)
         return output
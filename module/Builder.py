@@ -6,6 +6,8 @@
 # since          : 2011-07-22
 # last modified  : 2011-08-03
 
+from os     import path
+
 from module import XmlParser
 from module import Isa
 from module import Registers
@@ -42,8 +44,7 @@ class InstructionBuilder(Builder):
         reader = XmlParser.InstructionReader(config)
         instruction_language     = reader.data['language']
         instruction_size         = reader.data['size']
-        # We're not currently using this data. It can link the config
-        # to a specific api implementation.
+        # Links the config to an api implementation (see Api.get_api).
         instruction_api          = reader.data['api']
         instruction_formats      = reader.data['formats']
         instruction_instructions = reader.data['instructions']
@@ -76,6 +77,10 @@ class InstructionBuilder(Builder):
             self.obj.add_format_property_cycles(
                 instruction_format[0], instruction_format[3])
 
+        self.obj.build_field_extractors()
+        self.obj.build_descriptors()
+        self.obj.build_decode_table()
+
 class RegisterBuilder(Builder):
     def make(self, **args):
         config = args['filename']
@@ -109,6 +114,7 @@ class MemoryBuilder(Builder):
 
         reader = XmlParser.MachineReader(config)
         machine_memory = reader.data['memory']
+        machine_image  = reader.data['image']
         del reader
 
         data = machine_memory[0:3]
@@ -117,12 +123,24 @@ class MemoryBuilder(Builder):
             self.obj.open_log(self.logger)
         self.obj.component_id='MEM'
 
+        # Images are named relative to the configuration. One backing
+        # the whole address space goes first so segments can cover it.
+        if machine_image[0] != None:
+            self.obj.map_file(path.join(config, machine_image[0]), 0,
+                              mode=machine_image[1])
+
         segments = machine_memory[3:]
         for segment in segments:
             name  = segment[0]
             start = segment[1]
             end   = segment[2]
-            self.obj.add_segment(name, start, end)
+            image = segment[3]
+            mode  = segment[4]
+            self.obj.add_segment(name, start, end,
+                                 restricted=segment[5], access=segment[6])
+            if image != None:
+                self.obj.map_file(path.join(config, image), start, end,
+                                  mode=mode)
 
 class PipelineBuilder(Builder):
     def make(self, **args):
@@ -17,10 +17,102 @@ class LoggerClient(object):
     def add_logger(self, logger):
         pass
 
+class UnknownTopicException(Exception):
+    pass
+
 class UpdateListener(object):
     def update(self, *args, **kwargs):
         pass
 
+class Subscription(object):
+    """Describes what a listener is sent, and when.
+
+    Topics are any of `registers', `memory', `pipeline' and `pc'.
+    Registers may be narrowed to a list of numbers, and memory to a
+    list of inclusive (start, end) ranges of offsets.
+
+    Updates are delivered every cycle by default. Every delivers them
+    every N cycles, hz at most that many times a second, and
+    on_breakpoint only when a breakpoint is hit. Whatever the policy,
+    an update is delivered when the processor stops on an exception.
+    Changes which weren't delivered are carried to the next update.
+
+    Usage:
+        subscription=Subscription(topics=['pc', 'registers'],
+                                  registers=[2, 4], hz=10)
+    """
+    topics = ('registers', 'memory', 'pipeline', 'pc')
+
+    def __init__(self, topics=None, registers=None, memory=None,
+                 every=1, hz=None, on_breakpoint=False):
+        if topics is None:
+            topics = Subscription.topics
+        for topic in topics:
+            if topic not in Subscription.topics:
+                raise UnknownTopicException(
+                    "no such topic `{:}'".format(topic))
+        self.topics        = frozenset(topics)
+        self.registers     = registers
+        self.memory        = memory
+        self.every         = every
+        self.hz            = hz
+        self.on_breakpoint = on_breakpoint
+
+        # Changes waiting to be delivered. The first update is full.
+        self.changed_registers = set()
+        self.changed_memory    = set()
+        self.full              = True
+        self.pipeline          = []
+
+        self._count = 0
+        self._last  = None
+
+    def wants(self, topic):
+        return topic in self.topics
+
+    def wants_register(self, number):
+        return self.registers is None or number in self.registers
+
+    def wants_offset(self, offset):
+        if self.memory is None:
+            return True
+        for (start, end) in self.memory:
+            if start <= offset <= end:
+                return True
+        return False
+
+    def note(self, registers, memory, full=False):
+        """Carries changes until the next delivery."""
+        if full:
+            self.full = True
+        if self.full:
+            return
+        if 'registers' in self.topics:
+            self.changed_registers.update(registers)
+        if 'memory' in self.topics:
+            if self.memory is None:
+                self.changed_memory.update(memory)
+            else:
+                self.changed_memory.update(
+                    offset for offset in memory if self.wants_offset(offset))
+
+    def due(self, now, trapped=False, halted=False):
+        """Returns true if an update should be delivered now."""
+        self._count = self._count + 1
+        if halted:
+            return True
+        if self.on_breakpoint:
+            return trapped
+        if self.hz:
+            return self._last is None or now - self._last >= 1.0 / self.hz
+        return self._count % self.every == 0
+
+    def delivered(self, now):
+        self.changed_registers.clear()
+        self.changed_memory.clear()
+        self.full  = False
+        self._last = now
+
 class UpdateBroadcaster(object):
     def register(self, listeners, listener):
         """Registers an observer."""
@@ -9,8 +9,67 @@
 
 from lib.Functions import dump_accessors
 
+class DecodedFields(dict):
+    """Maps the fields of an executing instruction to unsigned values.
+
+    The two's complement reading of every field is held in `signed'.
+    """
+    __slots__ = ('signed',)
+
+def split_fields(extractors, word):
+    """Applies (field, shift, mask, sign) extractors to a word."""
+    fields = DecodedFields()
+    signed = fields.signed = {}
+    for (field, shift, mask, sign) in extractors:
+        value = (word >> shift) & mask
+        fields[field] = value
+        signed[field] = value - ((value & sign) << 1)
+    return fields
+
+class Instruction(object):
+    """Describes how to execute one instruction of the ISA.
+
+    Descriptors are built once by the Isa. A processor binds them to
+    its API so that executing an instruction needs no further lookups.
+    """
+    __slots__ = ('name', 'format', 'size', 'cycles', 'extractors',
+                 'methods', 'calls')
+
+    def __init__(self, name, format_name, size, cycles, extractors,
+                 methods, calls=()):
+        self.name       = name
+        self.format     = format_name
+        self.size       = size
+        self.cycles     = cycles
+        self.extractors = extractors
+        self.methods    = methods
+        self.calls      = calls
+
+    def bind(self, api):
+        """api:object -> Instruction
+
+        Returns a copy of the descriptor holding the API's bound
+        methods with their arguments.
+
+        Raises:
+            AttributeError if the API lacks a method.
+        """
+        calls = tuple((getattr(api, method), args)
+                      for (method, args) in self.methods)
+        return Instruction(self.name, self.format, self.size, self.cycles,
+                           self.extractors, self.methods, calls)
+
+    def extract(self, word):
+        """Splits an instruction word into its fields.
+
+        Returns:
+            DecodedFields holding unsigned and signed field values.
+        """
+        return split_fields(self.extractors, word)
+
 class BaseIsa(object):
-    _data={}
+    def __init__(self):
+        self._data={}
 
 class Isa(BaseIsa):
     def set_global_language(self, language):
@@ -90,6 +149,145 @@ class Isa(BaseIsa):
                self._data['format_property_cycles'] = {}
         self._data['format_property_cycles'][format_name] = cycles
 
+    def build_field_extractors(self):
+        """Computes a shift and mask for every field of every format.
+
+        Purpose:
+            Fields are numbered from the most significant bit of an
+            instruction of the format's size. Holding the shift and mask
+            for each lets fields be read from the integer word directly.
+
+        Restrictions:
+            Must be called after all formats have been added.
+        """
+        sizes      = self._data['format_property_size']
+        extractors = {}
+        for (format_name, fields) in self._data['format_properties'].items():
+            size = sizes[format_name]
+            data = []
+            for field in fields:
+                (start, end) = fields[field]
+                width = end - start + 1
+                data.append((field, size - end - 1, (1 << width) - 1,
+                             1 << (width - 1)))
+            extractors[format_name] = tuple(data)
+        self._data['format_extractors'] = extractors
+
+    def extract_fields(self, format_name, word):
+        """Splits an instruction word into the fields of its format.
+
+        Returns:
+            DecodedFields holding unsigned and signed field values.
+        """
+        return split_fields(self._data['format_extractors'][format_name],
+                            word)
+
+    def build_descriptors(self):
+        """Builds an Instruction descriptor for every instruction.
+
+        Restrictions:
+            Must be called after build_field_extractors.
+        """
+        mappings   = self._data['itof']
+        sizes      = self._data['format_property_size']
+        cycles     = self._data['format_property_cycles']
+        extractors = self._data['format_extractors']
+        descriptors = {}
+        for (name, methods) in self._data['instruction_implementation'].items():
+            format_name = mappings[name]
+            descriptors[name] = Instruction(
+                name, format_name, sizes[format_name], cycles[format_name],
+                extractors[format_name], tuple(methods))
+        self._data['descriptors'] = descriptors
+
+    def bind_descriptors(self, api):
+        """api:object -> {instruction:str->descriptor:Instruction}:dict
+
+        Returns descriptors for every instruction bound to the API.
+        """
+        descriptors = self._data['descriptors']
+        return dict((name, descriptors[name].bind(api))
+                    for name in descriptors)
+
+    def get_descriptors(self):
+        return self._data['descriptors']
+
+    def build_decode_table(self):
+        """Compiles instruction signatures into a decode table.
+
+        Purpose:
+            Each signature is reduced to a mask and value pair on the
+            integer instruction word. Pairs sharing a mask are grouped
+            in a dict keyed on the masked value, so decoding costs one
+            lookup per distinct mask rather than a walk over every
+            format and instruction.
+
+            Where more than one signature matches a word, the first
+            found walking formats then signatures wins, as it always
+            has done.
+
+        Restrictions:
+            Must be called after all formats and instructions have
+            been added. Signature fields which lie outside the first
+            word of an instruction cannot be decoded and are ignored.
+        """
+        size       = self._data['global_size']
+        bit_ranges = self._data['format_properties']
+        cycles     = self._data['format_property_cycles']
+        signatures = self._data['instruction_signatures']
+        mappings   = self._data['itof']
+
+        # Groups are {mask:{value:(priority, decoded)}}.
+        groups   = {}
+        priority = 0
+        for format_type in bit_ranges:
+            for signature in signatures:
+                if mappings[signature] != format_type:
+                    continue
+                mask  = 0
+                value = 0
+                for field in signatures[signature]:
+                    (start, end) = bit_ranges[format_type][field]
+                    width = end - start + 1
+                    shift = size - end - 1
+                    field_value = signatures[signature][field]
+                    if shift < 0 or field_value >> width:
+                        break
+                    mask  = mask  | (((1 << width) - 1) << shift)
+                    value = value | (field_value << shift)
+                else:
+                    decoded = (format_type, signature, cycles[format_type])
+                    table = groups.setdefault(mask, {})
+                    if value not in table:
+                        table[value] = (priority, decoded)
+                priority = priority + 1
+
+        # Masks are tried in order of their most important signature,
+        # which lets decode stop as soon as no better match can exist.
+        table = []
+        for mask in groups:
+            first = min(entry[0] for entry in groups[mask].values())
+            table.append((first, mask, groups[mask]))
+        table.sort()
+        self._data['decode_table'] = tuple(table)
+
+    def decode(self, word):
+        """Identifies an instruction from its first word.
+
+        Returns:
+            Tuple of (format, instruction, number_of_parts), or None if
+            the word matches no signature.
+        """
+        best = None
+        for (first, mask, values) in self._data['decode_table']:
+            if best is not None and first > best[0]:
+                break
+            entry = values.get(word & mask)
+            if entry is not None and (best is None or entry[0] < best[0]):
+                best = entry
+        if best is not None:
+            return best[1]
+
     def get_instruction_to_format_map(self):
         """Returns a dict mapping each instruction to its format.
 
@@ -121,6 +319,10 @@ class Isa(BaseIsa):
     def getSize(self):
         return self._data['global_size']
 
+    def get_api(self):
+        """Returns the name of the api the ISA is implemented with."""
+        return self._data['global_api']
+
     def get_size(self):
         return self._data['global_size']
 
@@ -166,17 +368,6 @@ class Isa(BaseIsa):
 class InstructionSet(object):
     """Provides an interface that should be used to load an ISA."""
 
-    _language=None
-    _size=None
-    _instruction_implementation={}
-    _instruction_fields={}
-    _instruction_signature={}
-    _instruction_format={}
-    _instruction_syntax={}
-    _label_replacement={}
-    _format_fields={}
-    _assembly_syntax={}
-    _assembly_directives={}
     def __init__(self, language, size):
         """(language:str, size:int) -> ...
 
@@ -191,6 +382,15 @@ class InstructionSet(object):
         """
         self._language = language
         self._size     = size
+        self._instruction_implementation = {}
+        self._instruction_fields         = {}
+        self._instruction_signature      = {}
+        self._instruction_format         = {}
+        self._instruction_syntax         = {}
+        self._label_replacement          = {}
+        self._format_fields              = {}
+        self._assembly_syntax            = {}
+        self._assembly_directives        = {}
 
     def addImplementation(self, instruction, methods):
         """(instruction:str, [(methods:str,[field:str]:list):tuple]:list) ->
@@ -8,10 +8,21 @@
 #     2011-08-18 : Improved documentation
 #     2011-08-30 : Removed redundant DFE
 
+from array      import array
+from binascii   import unhexlify
+from ctypes     import c_ubyte
+from mmap       import mmap, ACCESS_COPY, ACCESS_WRITE
+from weakref    import ref
 from Interface  import LoggerClient
+from re         import compile
+from struct     import Struct
 from Logger     import MemoryLogger
 from Logger     import level
 from lib.Functions  import binary as bin
+try:
+    from numpy  import frombuffer
+except ImportError, e:
+    frombuffer = None
 
 class AddressingError(Exception):
     pass
@@ -26,6 +37,9 @@ class AlignmentError(Exception):
 class SegmentationFaultException(Exception):
     pass
 
+class HexFormatException(Exception):
+    pass
+
 
 
 
@@ -122,21 +136,56 @@ class BaseMemory(LoggerClient):
 class Memory(BaseMemory):
     """Provides an interface that should be used to initialize the memory.
 
-    This memory model is big-endian. For representations of many
-    systems this will have to be extended.
+    This memory model is big-endian unless endian='Little' is given,
+    in which case the least significant unit of a word is stored at
+    the lowest offset.
 
-    Segmentation is not currently enforced. A program may write
-    to any valid memory address.
+    Segments are only enforced if they are restricted; a program may
+    otherwise read, write or execute any valid memory address, unless
+    it is mapped from a file read-only.
     """
 
     #
-    # Memory is implemented as a dict. To avoid wasted (real) memory,
-    # a range is stored indicating the bounds of each segment, but
-    # no space is reserved. This makes sense for 32-bit+ ISAs, and
-    # spares us the embarrasment trying to malloc 4GB.
+    # Memory is implemented as pages of addressable units, held in a
+    # dict by page number. To avoid wasted (real) memory, a page is only
+    # allocated when it is first written; reads of other pages are 0.
+    # This makes sense for 32-bit+ ISAs, and spares us the embarrasment
+    # trying to malloc 4GB. Small address spaces have all their pages
+    # allocated up front.
     #
-    _address={}
-    _segment={}
+
+    # Finds runs of units other than 0 in a bytearray page.
+    _nonzero = compile('[^\x00]+')
+
+    # Units in a page, as a power of 2.
+    _page_bits   = 12
+    # Address spaces up to this many units are allocated up front.
+    _dense_limit = 1 << 20
+
+    # A granule of zeros, which parts of a page are compared with
+    # before they are searched.
+    _zeros = buffer('\x00' * (1 << _page_bits))
+
+    # Access permissions of the granules of a restricted memory. A
+    # granule which segments only partly cover is mixed, and checked
+    # against the segments themselves.
+    _read    = 1
+    _write   = 2
+    _execute = 4
+    _mixed   = 8
+    _permissions = {'r':_read, 'w':_write, 'x':_execute, '-':0}
+    # Access to segments which don't say, when they are restricted.
+    _default_access = {'text':'rx', 'data':'rw', 'stack':'rw'}
+    # The permission table has at most this many granules.
+    _access_limit = 1 << 20
+
+    # How files are mapped for each mode of map_file.
+    _modes = {'read-only'     : ACCESS_COPY,
+              'copy-on-write' : ACCESS_COPY,
+              'shared'        : ACCESS_WRITE}
+
+    # Words of these sizes are moved to and from byte pages whole.
+    _formats = {8:'B', 16:'H', 32:'I', 64:'Q'}
 
     #def __init__(self, instructions, data):
     def __init__(self, data, *args, **kwargs):
@@ -166,14 +215,64 @@ class Memory(BaseMemory):
         #    raise DataFormatException("Data incomplete")
         #constant values
         self._types         = Enum(["Big", "Little"])
-        self._endian        = self._types.Big
+        self._endian        = kwargs.get('endian', self._types.Big)
+        if self._endian not in self._types:
+            raise Exception('Unknown endianness {:}'.format(self._endian))
         #computed values
         self._word_spacing = (self._size/self._addressable)
-
-    def add_segment(self, name, start, end):
-        """(name:str, start:int, end:int) -> segment{name:[start,end]:list}:dict
+        #segments by name, as [start, end]
+        self._segment = {}
+        #packers for aligned words of byte-addressed memory
+        self._structs = {}
+        if self._addressable == 8:
+            order = self._endian == self._types.Big and '>' or '<'
+            for (size, code) in self._formats.items():
+                self._structs[size] = Struct(order + code)
+        #pages of memory, by page number
+        self._dense     = self._address_space + 1 <= self._dense_limit
+        self._page_mask = (1 << self._page_bits) - 1
+        self._pages     = {}
+        self._allocate()
+        #callables told of every store
+        self._write_observers = []
+        #views of earlier versions share undo records of the values
+        #overwritten since they were taken
+        self._version = 0
+        self._shadow  = None
+        #files mapped into the address space, the pages they make
+        #read-only and the pages stored through to a file
+        self._mappings = []
+        self._readonly = set()
+        self._through  = set()
+        #pages a snapshot holds, which are copied before a store, and
+        #the pages which stores must prepare for: these and read-only
+        self._snapped  = set()
+        self._guarded  = set()
+        #a bit for each page-sized granule stored to since clear_dirty
+        self._dirty_bits = Memory._page_bits
+        self._dirty      = bytearray(
+            ((self._address_space >> self._dirty_bits) >> 3) + 1)
+        #segments as (start, end, permissions), and a permission table
+        #of granules, built once a segment is restricted
+        self._intervals   = []
+        self._access      = None
+        self._access_bits = max(Memory._page_bits,
+                                self._address_space.bit_length() -
+                                self._access_limit.bit_length() + 1)
+
+    def add_segment(self, name, start, end, restricted=False, access=None):
+        """(name:str, start:int, end:int, restricted:bool, access:str)
+            -> segment{name:[start,end]:list}:dict
 
         Designates a new segment with implicit access controls.
+
+        Access is enforced for restricted segments only, and is any of
+        r(ead), w(rite) and (e)x(ecute), eg. `rx'. By default text may
+        be read and executed, and other segments read and written.
+        Where segments overlap, an access either allows is allowed.
+
+        Raises:
+            Exception if access isn't made of r, w, x and -.
         """
         #
         #It's a serious error not to receive both start and end
@@ -186,6 +285,352 @@ class Memory(BaseMemory):
                         .format(name, start, end), level.INFO)
         self._segment[name]=[start,end]
 
+        permissions = self._read | self._write | self._execute
+        if restricted:
+            if access == None:
+                access = self._default_access.get(name, 'rw')
+            permissions = 0
+            for flag in access:
+                if flag not in self._permissions:
+                    raise Exception('Unknown access {:} for segment {:}'
+                                    .format(access, name))
+                permissions = permissions | self._permissions[flag]
+            self.log.buffer("restricted segment `{0}' to {1}"
+                            .format(name, access), level.INFO)
+        self._intervals.append((start, end, permissions))
+        if restricted or self._access is not None:
+            self._build_access()
+
+    def _access_at(self, offset):
+        # Access allowed at an offset by the segments covering it, or
+        # any access if there aren't any.
+        covered = False
+        permissions = 0
+        for (start, end, allowed) in self._intervals:
+            if start <= offset <= end:
+                covered = True
+                permissions = permissions | allowed
+        if not covered:
+            return self._read | self._write | self._execute
+        return permissions
+
+    def _build_access(self):
+        # Compiles the segments into a table of permissions by granule.
+        # Access is the same between consecutive segment boundaries, so
+        # the table is filled a run at a time.
+        bits   = self._access_bits
+        points = set([0, self._address_space + 1])
+        for (start, end, allowed) in self._intervals:
+            points.update([start, end + 1])
+        points = sorted(points)
+        table  = bytearray((self._address_space >> bits) + 1)
+        for (low, high) in zip(points, points[1:]):
+            first = low >> bits
+            last  = (high - 1) >> bits
+            table[first:last + 1] = bytearray([self._access_at(low)]) * \
+                                    (last - first + 1)
+        for point in points[1:-1]:
+            if point & ((1 << bits) - 1):
+                table[point >> bits] = self._mixed
+        self._access = table
+
+    def _check_access(self, offset, units, wanted):
+        # Raises unless the access is allowed at every unit.
+        bits = self._access_bits
+        if (self._access[offset >> bits] &
+            self._access[(offset + units - 1) >> bits] & wanted):
+            return
+        for unit in range(offset, offset + units):
+            if not self._access_at(unit) & wanted:
+                kind = {self._read:'read', self._write:'write',
+                        self._execute:'execute'}[wanted]
+                self.log.buffer('Segmantation violation: {:} at {:}'
+                                .format(kind, hex(unit).replace('L','')),
+                                level.ERROR)
+                raise SegmentationFaultException(
+                    '{:} at {:} is not allowed'
+                    .format(kind, hex(unit).replace('L','')))
+
+    def add_write_observer(self, observer):
+        """observer:callable -> ...
+
+        Registers a callable which is told of every store as
+        observer(offset, length), where length counts addressable
+        units. A reset is reported as a store to the whole address
+        space.
+        """
+        if observer not in self._write_observers:
+            self._write_observers.append(observer)
+
+    def remove_write_observer(self, observer):
+        """De-registers a write observer."""
+        if observer in self._write_observers:
+            self._write_observers.remove(observer)
+
+    def map_file(self, filename, start, end=None, mode='copy-on-write'):
+        """(filename:str, start:int, end:int, mode:str) -> ...
+
+        Backs memory from start with an mmap of a file, so that its
+        contents are there without being stored. The mapping ends at
+        end, or with the file if that is shorter.
+
+        Modes:
+            read-only     -- stores in the mapping raise a
+                             SegmentationFaultException
+            copy-on-write -- stores are seen only by the simulation
+            shared        -- stores are written through to the file
+
+        Pages wholly inside the mapping are the file itself. Parts of
+        pages at the ends of a mapping are copied in, and written back
+        to a shared file by sync.
+
+        A reset restores the mapping: copy-on-write pages are mapped
+        afresh, while a shared file keeps what was stored. Shared files
+        are not part of snapshots.
+        """
+        if self._addressable != 8:
+            raise Exception('Files can only be mapped into byte-'
+                            'addressed memory')
+        if not mode in self._modes:
+            raise Exception('Unknown mapping mode {:}'.format(mode))
+        if end == None:
+            end = self._address_space
+        if not self.in_range(start) or not self.in_range(end):
+            raise SegmentationFaultException(
+                'Mapping {:} at {:}..{:}'.format(filename, hex(start),
+                                                  hex(end)))
+        mapping = Mapping(filename, mode, start, end)
+        if not self._open_mapping(mapping):
+            return
+        self.log.buffer("mapped `{0}' at {1}..{2} {3}"
+                        .format(filename, hex(mapping.start),
+                                hex(mapping.end), mode),
+                        level.INFO)
+        self._version = self._version + 1
+        self._attach(mapping, self._live_shadow())
+        self._mappings.append(mapping)
+        for observer in self._write_observers:
+            observer(mapping.start, mapping.end - mapping.start + 1)
+
+    def dirty_pages(self):
+        """-> [offset:int]:list
+
+        Returns the offsets at which each page stored to since the last
+        clear_dirty begins, lowest first. Pages are get_page_size()
+        units long.
+
+        Loading, mapping files, resets and restores all count as stores.
+        """
+        pages = []
+        for match in self._nonzero.finditer(self._dirty):
+            for index in range(match.start(), match.end()):
+                bits = self._dirty[index]
+                for bit in range(8):
+                    if bits & (1 << bit):
+                        pages.append(((index << 3) | bit) << self._dirty_bits)
+        return pages
+
+    def clear_dirty(self):
+        """Marks every page clean."""
+        for match in self._nonzero.finditer(self._dirty):
+            self._dirty[match.start():match.end()] = \
+                bytearray(match.end() - match.start())
+
+    def get_page_size(self):
+        """Returns the number of addressable units in a dirty page."""
+        return 1 << self._dirty_bits
+
+    def _mark(self, offset, length):
+        # Marks the pages from offset for length units dirty.
+        for granule in range(offset >> self._dirty_bits,
+                             ((offset + length - 1) >> self._dirty_bits) + 1):
+            self._dirty[granule >> 3] |= 1 << (granule & 7)
+
+    def sync(self):
+        """Writes stores in shared mappings through to their files."""
+        for mapping in self._mappings:
+            if mapping.mode == 'shared':
+                for (low, high) in self._edges(mapping):
+                    page = self._pages[low >> self._page_bits]
+                    mapping.map[low - mapping.start:high - mapping.start + 1] = \
+                        str(bytearray(page[low & self._page_mask:
+                                           (high & self._page_mask) + 1]))
+                mapping.map.flush()
+
+    def _open_mapping(self, mapping):
+        # Maps the file, trimming the mapping to its length. Empty
+        # files are not mapped.
+        if mapping.mode == 'shared':
+            flags = 'r+b'
+        else:
+            flags = 'rb'
+        with open(mapping.filename, flags) as image:
+            image.seek(0, 2)
+            length = image.tell()
+            if length == 0:
+                return False
+            mapping.map = mmap(image.fileno(), 0,
+                               access=self._modes[mapping.mode])
+        mapping.end = min(mapping.end, mapping.start + length - 1)
+        return True
+
+    def _edges(self, mapping):
+        # The (low, high) parts of pages which a mapping only covers in
+        # part.
+        size  = 1 << self._page_bits
+        first = mapping.start >> self._page_bits
+        last  = mapping.end >> self._page_bits
+        edges = []
+        for number in set([first, last]):
+            low  = max(mapping.start, number << self._page_bits)
+            high = min(mapping.end, (number << self._page_bits) + size - 1)
+            if high - low + 1 < size:
+                edges.append((low, high))
+        return edges
+
+    def _attach(self, mapping, shadow):
+        # Puts the pages of a mapping in place of those it covers,
+        # saving what they held for views.
+        size  = 1 << self._page_bits
+        edges = dict(self._edges(mapping))
+        self._mark(mapping.start, mapping.end - mapping.start + 1)
+        first = mapping.start >> self._page_bits
+        last  = mapping.end >> self._page_bits
+        for number in range(first, last + 1):
+            base = number << self._page_bits
+            low  = max(mapping.start, base)
+            high = min(mapping.end, base + size - 1)
+            if shadow is not None:
+                self._save(shadow, low, high, mapping.map, mapping.start)
+            if low in edges:
+                page = self._unshare(number)
+                if page is None:
+                    page = self._pages[number] = self._new_page()
+                page[low & self._page_mask:(high & self._page_mask) + 1] = \
+                    mapping.map[low - mapping.start:high - mapping.start + 1]
+            else:
+                self._snapped.discard(number)
+                self._pages[number] = (c_ubyte * size).from_buffer(
+                    mapping.map, base - mapping.start)
+            if mapping.mode == 'read-only':
+                self._readonly.add(number)
+            elif mapping.mode == 'shared':
+                self._through.add(number)
+            self._guard(number)
+
+    def _save(self, shadow, low, high, new, start):
+        # Saves the values from low to high before they are replaced
+        # from new, a buffer beginning at offset start. Only offsets
+        # where either isn't 0 need saving.
+        if self._addressable > 8:
+            for offset in range(low, high + 1):
+                if offset not in shadow.values:
+                    shadow.values[offset] = self._peek(offset)
+            return
+        base = low & ~self._page_mask
+        for (page, first) in ((self._pages.get(low >> self._page_bits), base),
+                              (new, start)):
+            if page is None:
+                continue
+            for match in self._nonzero.finditer(page, low - first,
+                                                high - first + 1):
+                for index in range(match.start(), match.end()):
+                    offset = first + index
+                    if offset not in shadow.values:
+                        shadow.values[offset] = self._peek(offset)
+
+    def _guard(self, number):
+        # Stores to read-only and snapshot pages must be prepared for.
+        if number in self._readonly or number in self._snapped:
+            self._guarded.add(number)
+        else:
+            self._guarded.discard(number)
+
+    def _unshare(self, number):
+        # Returns a page which may be stored to, copying it first if a
+        # snapshot holds it.
+        page = self._pages.get(number)
+        if number in self._snapped:
+            self._snapped.discard(number)
+            self._guard(number)
+            if page is not None:
+                if self._addressable <= 8:
+                    page = bytearray(page)
+                else:
+                    page = page[:]
+                self._pages[number] = page
+        return page
+
+    def _prepare_store(self, number, offset, units):
+        # Returns the page for a store to a guarded page.
+        if number in self._readonly:
+            self._check_store(offset, units)
+        return self._unshare(number)
+
+    def _check_store(self, offset, units):
+        # Raises if a store overlaps a read-only mapping.
+        for mapping in self._mappings:
+            if (mapping.mode == 'read-only' and offset <= mapping.end
+                and offset + units - 1 >= mapping.start):
+                self.log.buffer('Segmantation violation: {:} is read-only'
+                                .format(hex(offset).replace('L','')),
+                                level.ERROR)
+                raise SegmentationFaultException('{:} is read-only'
+                                     .format(hex(offset).replace('L','')))
+
+    def snapshot(self):
+        """-> snapshot:Snapshot
+
+        Returns a snapshot of memory which restore can return to.
+
+        Pages are shared with the snapshot rather than copied. A page
+        is copied when it is first stored to afterwards, so the cost of
+        a snapshot is in proportion to the pages changed while it is
+        held, not to the size of memory.
+        """
+        pages = {}
+        for (number, page) in self._pages.items():
+            if number not in self._through:
+                pages[number] = page
+                self._snapped.add(number)
+                self._guarded.add(number)
+        return Snapshot(self, pages)
+
+    def restore(self, snapshot):
+        """snapshot:Snapshot -> ...
+
+        Returns memory to the state it was in when the snapshot was
+        taken. Only pages changed since are replaced, and they are
+        shared again, so a snapshot may be restored any number of
+        times.
+        """
+        if snapshot.memory is not self:
+            raise Exception('Restoring a snapshot of other memory')
+        size    = 1 << self._page_bits
+        shadow  = self._live_shadow()
+        pages   = snapshot.pages
+        changed = [number for number in set(self._pages) | set(pages)
+                   if number not in self._through and
+                   self._pages.get(number) is not pages.get(number)]
+        self.log.buffer('restoring {:} pages'.format(len(changed)),
+                        level.FINE)
+        self._version = self._version + 1
+        for number in changed:
+            base = number << self._page_bits
+            page = pages.get(number)
+            if shadow is not None:
+                self._save(shadow, base, base + size - 1, page, base)
+            if page is None:
+                del self._pages[number]
+                self._snapped.discard(number)
+            else:
+                self._pages[number] = page
+                self._snapped.add(number)
+            self._guard(number)
+            self._mark(base, size)
+            for observer in self._write_observers:
+                observer(base, size)
+
     def get_slice(self, end=None, start=None):
         """(end:int, start:int)->{address:int->values:int}:dict
 
@@ -207,20 +652,182 @@ class Memory(BaseMemory):
 
         # FIX: Severe upset if addressable size is larger than a
         # word. (2011-08-17)
-        memory_slice={}
-        i = start
-        while i <= end:
-            i = int(i)
-            try:
-                memory_slice[i]=self.get_word(i,
-                                              self._size,
-                                              quietly=True)
-            except:
-                memory_slice[i]=0
-            i = int(i + (self._word_spacing))
+        # Words which aren't wholly in the address space read as 0.
+        addresses = range(int(start), int(end) + 1, self._word_spacing)
+        inside = [address for address in addresses
+                  if self.in_range(address) and
+                  self.in_range(address + self._word_spacing - 1)]
+        memory_slice = dict.fromkeys(addresses, 0)
+        if len(inside) > 0:
+            if self._addressable == 8:
+                words = self.read_range(inside[0], len(inside), words=True)
+            else:
+                words = [self.get_word(address, self._size, aligned=False,
+                                       quietly=True) for address in inside]
+            memory_slice.update(zip(inside, [int(word) for word in words]))
 
         return memory_slice
 
+    def read_range(self, start, length, words=False):
+        """(start:int, length:int, words:bool) -> memoryview or words
+
+        Returns length units of memory from start, straight from the
+        pages which hold them, as a read-only memoryview. A range in one
+        page views the page itself, which is then shared as it is with
+        a snapshot: nothing is copied, the view keeps the values read,
+        and the next store to the page copies that page alone. Longer
+        ranges are gathered into one buffer. Pages never written read
+        as 0.
+
+        With words set, length counts words, which are returned as a
+        NumPy array if NumPy is installed and a list if it isn't.
+
+        Raises:
+            SegmentationFaultException
+        """
+        count = length
+        if words:
+            length = length * self._word_spacing
+        self._check_range(start, length)
+        number = start >> self._page_bits
+        page   = self._pages.get(number)
+        if (page is not None and length > 0 and number not in self._through
+            and (start + length - 1) >> self._page_bits == number):
+            self._snapped.add(number)
+            self._guarded.add(number)
+            data = memoryview(buffer(page, start & self._page_mask, length))
+        else:
+            data = memoryview(buffer(self._gather(start, length)))
+        if words:
+            return self._unpack(data, count)
+        return data
+
+    def _check_range(self, start, length):
+        # Ranges must be of byte-addressed memory, and in range.
+        if self._addressable != 8:
+            raise Exception('Ranges can only be read from byte-addressed '
+                            'memory')
+        if (length < 0 or not self.in_range(start) or
+            not self.in_range(start + max(length, 1) - 1)):
+            raise SegmentationFaultException(
+                '{:}..{:} is out of bounds'
+                .format(hex(start).replace('L',''),
+                        hex(start + length - 1).replace('L','')))
+
+    def _gather(self, start, length):
+        # Copies a range of memory into one buffer.
+        data = bytearray(length)
+        size = 1 << self._page_bits
+        end  = start + length - 1
+        low  = start
+        while low <= end:
+            number = low >> self._page_bits
+            high   = min(end, (number << self._page_bits) + size - 1)
+            page   = self._pages.get(number)
+            if page is not None:
+                data[low - start:high - start + 1] = buffer(
+                    page, low & self._page_mask, high - low + 1)
+            low = high + 1
+        return data
+
+    def _unpack(self, data, count):
+        # Returns the words in a buffer.
+        order = self._endian == self._types.Big and '>' or '<'
+        if frombuffer is not None and self._size in self._formats:
+            return frombuffer(data, dtype='{:}u{:}'.format(
+                order, self._word_spacing), count=count)
+        if self._size in self._formats:
+            return list(Struct(order + str(count) + self._formats[self._size])
+                        .unpack_from(data))
+        words = []
+        for index in range(count):
+            unit = bytearray(data[index * self._word_spacing:
+                                  (index + 1) * self._word_spacing])
+            if order == '<':
+                unit.reverse()
+            value = 0
+            for byte in unit:
+                value = (value << 8) | byte
+            words.append(value)
+        return words
+
+
+    def view(self):
+        """-> view:MemoryView
+
+        Returns a read-only view of the memory as it is now. Nothing is
+        copied: while a view is held, stores first save the values they
+        overwrite in an undo record which the view reads through.
+        """
+        shadow = self._live_shadow()
+        if shadow is None or len(shadow.values) > 0:
+            newer = Shadow()
+            if shadow is not None:
+                shadow.newer = newer
+            shadow = newer
+            self._shadow = ref(shadow)
+        return MemoryView(self, shadow, self._version)
+
+    def _live_shadow(self):
+        # Returns the newest undo record if any view still needs it.
+        if self._shadow is None:
+            return None
+        shadow = self._shadow()
+        if shadow is None:
+            self._shadow = None
+        return shadow
+
+    def _allocate(self):
+        # Small address spaces have every page allocated up front.
+        if self._dense:
+            for number in range((self._address_space >> self._page_bits) + 1):
+                self._pages[number] = self._new_page()
+
+    def _new_page(self):
+        # Pages hold units in the narrowest type which fits them.
+        length = 1 << self._page_bits
+        if self._addressable <= 8:
+            return bytearray(length)
+        for typecode in ('H', 'I', 'L'):
+            if array(typecode).itemsize * 8 >= self._addressable:
+                return array(typecode, [0]) * length
+        return [0] * length
+
+    def _peek(self, offset):
+        # Reads a stored value without allocating memory.
+        page = self._pages.get(offset >> self._page_bits)
+        if page is None:
+            return 0
+        return page[offset & self._page_mask]
+
+    def _stored(self):
+        # Yields (offset, value) for every unit which isn't 0.
+        for (number, page) in self._pages.items():
+            base = number << self._page_bits
+            if self._addressable <= 8:
+                if buffer(page) == self._zeros:
+                    continue
+                for match in self._nonzero.finditer(page):
+                    for offset in range(match.start(), match.end()):
+                        yield (base + offset, page[offset])
+            else:
+                for offset in range(len(page)):
+                    if page[offset]:
+                        yield (base + offset, page[offset])
+
+    def get_values(self, offsets=None):
+        """offsets:iterable -> {offset:int->value:int}:dict
+
+        Returns the values held at each addressable offset, or every
+        value other than 0 if no offsets are given. Offsets which have
+        never been stored read as 0.
+        """
+        if offsets is None:
+            return dict(self._stored())
+        values = {}
+        for offset in offsets:
+            values[offset] = self._peek(offset)
+        return values
 
     def load_text(self, text, and_dump=False):
         """Stores a program at sequential addressing in memory.
@@ -253,7 +860,8 @@ class Memory(BaseMemory):
             if offset > self.get_end('text'):
                 raise SegmentationFaultException('{:} is out of bounds'
                                  .format(hex(offset).replace('L','')))
-            self.set_word(offset, line, self._size)
+            # Loading is not subject to segment access.
+            self._put_word(offset, line, self._size)
             # bit silly, but in line with assembler's return tuple
             binary.append(line)
             address.append(offset)
@@ -269,10 +877,102 @@ class Memory(BaseMemory):
         """Synonymous with load_text with the dump option set"""
         return self.load_text(text=text, and_dump=True)
 
-    def get_word(self, offset, size, aligned=True, quietly=False):
+    def load_image(self, data, offset=None, and_dump=False):
+        """(data:buffer, offset:int, and_dump:bool) -> (binary, address)
+
+        Copies a program image into memory in one operation, from offset
+        or the start of text. The image may run on from text into data.
+
+        Unlike load_text, words are not stored one by one: the image is
+        copied into each page it covers as a whole, and write observers
+        are told of one store.
+
+        Returns:
+            Tuple of the words loaded and their memory addresses, as
+            with load_text. Both are worked out as they are asked for.
+        """
+        if offset == None:
+            offset = self.get_start('text')
+        return self._load_chunks([(offset, data)], and_dump)
+
+    def load_binary(self, filename, offset=None, and_dump=False):
+        """Loads a raw binary file with load_image."""
+        with open(filename, 'rb') as image:
+            data = image.read()
+        return self.load_image(data, offset, and_dump)
+
+    def load_hex(self, filename, and_dump=False):
+        """Loads an Intel HEX file at the offsets given by its records.
+
+        Raises:
+            HexFormatException
+        """
+        with open(filename, 'r') as image:
+            chunks = read_hex(image)
+        return self._load_chunks(chunks, and_dump)
+
+    def _load_chunks(self, chunks, and_dump):
+        # Loads (offset, data) runs of an image after checking they lie
+        # in text or data.
+        if self._addressable != 8:
+            raise Exception('Images can only be loaded into byte-'
+                            'addressed memory')
+        #regular expressions can't search memoryviews
+        chunks = [(offset, isinstance(data, memoryview) and data.tobytes()
+                           or data)
+                  for (offset, data) in chunks if len(data) > 0]
+        low  = min(self.get_start('text'), self.get_start('data'))
+        high = max(self.get_end('text'), self.get_end('data'))
+        for (offset, data) in chunks:
+            if offset < low or offset + len(data) - 1 > high:
+                raise SegmentationFaultException(
+                    'Image at {:}..{:} is out of bounds'
+                    .format(hex(offset).replace('L',''),
+                            hex(offset + len(data) - 1).replace('L','')))
+        if and_dump == True:
+            self.reset()
+        for (offset, data) in chunks:
+            self._store_bytes(offset, data)
+        self.log.buffer('loaded {0} byte image into memory'
+                        .format(sum([len(data) for (offset, data) in chunks])),
+                        level.INFO)
+        little = self._endian == self._types.Little
+        return (LoadedImage(chunks, self._word_spacing, words=True,
+                            little=little),
+                LoadedImage(chunks, self._word_spacing))
+
+    def _store_bytes(self, offset, data):
+        # Copies a buffer into memory a page at a time, as one store.
+        # Loading is not subject to read-only mappings.
+        shadow = self._live_shadow()
+        self._version = self._version + 1
+        size = 1 << self._page_bits
+        end  = offset + len(data) - 1
+        low  = offset
+        while low <= end:
+            number = low >> self._page_bits
+            high   = min(end, (number << self._page_bits) + size - 1)
+            if shadow is not None:
+                self._save(shadow, low, high, data, offset)
+            page = self._unshare(number)
+            if page is None:
+                page = self._pages[number] = self._new_page()
+            chunk = data[low - offset:high - offset + 1]
+            if not isinstance(page, bytearray):
+                chunk = bytearray(chunk)
+            page[low & self._page_mask:(high & self._page_mask) + 1] = chunk
+            low = high + 1
+        self._mark(offset, len(data))
+        for observer in self._write_observers:
+            observer(offset, len(data))
+
+    def get_word(self, offset, size, aligned=True, quietly=False,
+                 execute=False):
         """(offset:int,
             size:int
-            aligned:bool) -> value:int
+            aligned:bool
+            quietly:bool
+            execute:bool) -> value:int
 
         Returns a tuple containing address offset and
         the decimal value of a word at that location.
@@ -281,10 +981,14 @@ class Memory(BaseMemory):
             offset  -- the address in memory
             size    -- the word size to get
             aligned -- is word alligment enforced?
+            quietly -- are errors left unlogged?
+            execute -- is the word fetched to execute?
 
         Raises:
             AddressingError
             AlignmentError
+            SegmentationFaultException if a restricted segment doesn't
+            allow the read or execution
         Allows:
             SegmentationFaultException
         Masks:
@@ -292,52 +996,58 @@ class Memory(BaseMemory):
         """
         #We want to prevent addressing violations
         if size < self._addressable:
+            message='Tried to address {:}-bytes at {:}'.format(
+                size/self._addressable, hex(offset))
             if not quietly:
-                message='Tried to address {:}-bytes at {:}'.format(
-                    size/self._addressable, hex(offset))
                 self.log.buffer('Addressing error: {:}'.format(message),
                                 level.ERROR)
             raise AddressingError(message)
 
+        units = size / self._addressable
+
         #We want to prevent bad alignment
-        #if aligned and int(offset) % size != 0:
-        if aligned and int(offset) % (size / self._addressable) != 0:
+        if aligned and int(offset) % units != 0:
+            message='Tried to load {:}-bytes from {:}'.format(
+                units, hex(offset))
             if not quietly:
-                message='Tried to load {:}-bytes from {:}'.format(
-                    size/self._addressable, hex(offset))
                 self.log.buffer('Alignment error: {:}'.format(message),
                                 level.ERROR)
             raise AlignmentError(message)
 
-        if self._endian == self._types.Little:
-            offset = offset - (size/self._addressable)
-
-        bitmap=[]
-        orig_offset=offset
-        start=0
-        end=self._addressable
-
-        for i in range(size/self._addressable):
-
-            byte = self._get_byte(offset)
-            bitmap[start:end] = bin(byte, self._addressable)[2:]
-
-            if self._endian == self._types.Big:
-                offset = offset + 1
+        if self._access is not None:
+            self._check_access(offset, units,
+                               execute and self._execute or self._read)
+
+        packed = self._structs.get(size)
+        if (packed is not None and offset % units == 0
+            and offset >= 0 and offset + units - 1 <= self._address_space):
+            #An aligned word never straddles two pages.
+            page = self._pages.get(offset >> self._page_bits)
+            if page is None:
+                value = 0
             else:
-                offset = offset - 1
-
-            start=end
-            end=end+self._addressable
+                value = packed.unpack_from(page, offset & self._page_mask)[0]
+        else:
+            value = 0
+            for unit in self._units(offset, units):
+                value = (value << self._addressable) | self._get_byte(unit)
 
-        bitmap=''.join(bitmap)
-        if not quietly:
+        if not quietly and self._logging(level.FINER):
             self.log.buffer('loaded {:} from {:}'
-                            .format(bitmap,
-                                    hex(orig_offset).replace('L', '')),
+                            .format(bin(value, size)[2:],
+                                    hex(offset).replace('L', '')),
                             level.FINER)
-        return int(bitmap, 2)
+        return value
+
+    def _units(self, offset, units):
+        # Offsets of the units of a word, most significant first.
+        if self._endian == self._types.Big:
+            return range(offset, offset + units)
+        return range(offset + units - 1, offset - 1, -1)
 
+    def _logging(self, logging):
+        # Messages are only formatted if the log would keep them.
+        return logging <= getattr(self.log, 'logging_level', level.NONE)
 
     def _get_byte(self, offset):
         #We want to prevent segmentation violations
@@ -347,14 +1057,8 @@ class Memory(BaseMemory):
                             level.ERROR)
             raise SegmentationFaultException('{:} is out of bounds'
                                  .format(hex(offset).replace('L','')))
-        #Expect a `key error' exception, but behave as though this was
-        #a successful memory read. Return 0.
-        try:
-            return self._address[offset]
-        except KeyError:
-            #We will initialize the memory to avoid future exceptions
-            self._set_byte(offset, 0)
-            return 0
+        #Pages which were never written read as 0.
+        return self._peek(offset)
 
     def set_word(self, offset, value, size, aligned=True):
         """Inserts a word at the given memory offset
@@ -362,9 +1066,10 @@ class Memory(BaseMemory):
         Description:
             (offset:int, value:int, size:int, aligned:bool)
                 -> **memory{offset:value}:dict**
-            set_word uses _set_byte to do its work by calling it repeatedly.
-            It will store a word in such a way that it remains addressable
-            in byte-sized portions. 
+            Aligned words of 8, 16, 32 or 64 bits in byte-addressed memory
+            are packed into their page whole; anything else uses _set_byte
+            for each unit. Either way a word remains addressable in
+            byte-sized portions.
 
         Purpose:
             Handles the storage of a word, ensuring addressing is correct
@@ -389,6 +1094,8 @@ class Memory(BaseMemory):
         Exceptions:
             Raises : AddressingError
                      AlignmentError
+                     SegmentationFaultException if a restricted
+                     segment doesn't allow the write
             Allows : SegmentationFaultException
             Masks  : None
 
@@ -416,24 +1123,51 @@ class Memory(BaseMemory):
                                          hex(offset).replace('L','')),
                                  level.ERROR)
 
-        if self._endian == self._types.Little:
-            offset = offset - (size/self._addressable)
-
-        orig_offset = offset
-        bitmap=bin(value, size)[2:]
-        start=0
-        end=self._addressable
-        for i in range(size/self._addressable):
-            self._set_byte(offset, int(bitmap[start:end],2))
-            start=end
-            end=end+self._addressable
-            if self._endian == self._types.Big:
-                offset = offset + 1
+        if self._access is not None:
+            self._check_access(offset, size / self._addressable,
+                               self._write)
+
+        self._put_word(offset, value, size)
+
+    def _put_word(self, offset, value, size):
+        # Stores a word without checking it may be.
+        units  = size / self._addressable
+        #Values are stored in size bits, negatives as two's complement.
+        value  = value & ((1 << size) - 1)
+        shadow = self._live_shadow()
+        self._version = self._version + 1
+        packed = self._structs.get(size)
+        if (packed is not None and offset % units == 0
+            and offset >= 0 and offset + units - 1 <= self._address_space):
+            number = offset >> self._page_bits
+            if number in self._guarded:
+                page = self._prepare_store(number, offset, units)
             else:
-                offset = offset - 1
-        self.log.buffer('stored {:} at {:}'
-                        .format(bitmap,hex(orig_offset)),
-                        level.FINER)
+                page = self._pages.get(number)
+            if page is None:
+                page = self._pages[number] = self._new_page()
+            if shadow is not None:
+                for unit in range(offset, offset + units):
+                    if unit not in shadow.values:
+                        shadow.values[unit] = self._peek(unit)
+            packed.pack_into(page, offset & self._page_mask, value)
+            granule = offset >> self._dirty_bits
+            self._dirty[granule >> 3] |= 1 << (granule & 7)
+        else:
+            mask  = (1 << self._addressable) - 1
+            shift = size
+            for unit in self._units(offset, units):
+                shift = shift - self._addressable
+                if shadow is not None and unit not in shadow.values:
+                    shadow.values[unit] = self._peek(unit)
+                self._set_byte(unit, (value >> shift) & mask)
+            self._mark(offset, units)
+        if self._logging(level.FINER):
+            self.log.buffer('stored {:} at {:}'
+                            .format(bin(value, size)[2:], hex(offset)),
+                            level.FINER)
+        for observer in self._write_observers:
+            observer(offset, units)
 
     def _set_byte(self, offset, value):
         #We want to prevent segmentation violations
@@ -444,7 +1178,14 @@ class Memory(BaseMemory):
             raise SegmentationFaultException('{:} is out of bounds'
                                  .format(hex(offset).replace('L','')),
                                             level.ERROR)
-        self._address[offset] = value
+        number = offset >> self._page_bits
+        if number in self._guarded:
+            page = self._prepare_store(number, offset, 1)
+        else:
+            page = self._pages.get(number)
+        if page is None:
+            page = self._pages[number] = self._new_page()
+        page[offset & self._page_mask] = value
 
     def reset(self):
         """... -> ...
@@ -453,7 +1194,28 @@ class Memory(BaseMemory):
         """
 
         self.log.buffer('core dumped to null', level.FINE)
-        self._address.clear()
+        shadow = self._live_shadow()
+        if shadow is not None:
+            for (offset, value) in self._stored():
+                if offset not in shadow.values:
+                    shadow.values[offset] = value
+        self._version = self._version + 1
+        if self._dense:
+            for (offset, value) in self._stored():
+                self._mark(offset, 1)
+        else:
+            for number in self._pages:
+                self._mark(number << self._page_bits, 1 << self._page_bits)
+        self.sync()
+        self._pages.clear()
+        self._snapped.clear()
+        self._guarded = set(self._readonly)
+        self._allocate()
+        for mapping in self._mappings:
+            if mapping.mode == 'shared' or self._open_mapping(mapping):
+                self._attach(mapping, shadow)
+        for observer in self._write_observers:
+            observer(0, self._address_space + 1)
 
     def in_range(self, address):
         """address:int -> bool"""
@@ -477,3 +1239,220 @@ class Memory(BaseMemory):
 
     def get_word_size(self):
         return self._size
+
+
+class Shadow(object):
+    """Values overwritten since a version of memory was viewed.
+
+    Records form a chain from older versions to newer ones. Only views
+    hold them, so a record is freed with the last view needing it.
+    """
+    __slots__ = ('values', 'newer', '__weakref__')
+
+    def __init__(self):
+        self.values = {}
+        self.newer  = None
+
+def read_hex(lines):
+    """lines:iterable -> [(offset:int, data:bytearray)]:list
+
+    Reads the records of an Intel HEX file, returning their data as
+    runs of consecutive offsets. Start address records are ignored.
+
+    Raises:
+        HexFormatException
+    """
+    chunks = []
+    base   = 0
+    for (number, line) in enumerate(lines):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            if line[0] != ':':
+                raise TypeError('no start code')
+            record = bytearray(unhexlify(line[1:]))
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise TypeError('bad record length')
+            if sum(record) & 0xff != 0:
+                raise TypeError('bad checksum')
+        except TypeError, e:
+            raise HexFormatException('line {:}: {:}'.format(number + 1, e))
+        kind    = record[3]
+        address = (record[1] << 8) | record[2]
+        data    = record[4:-1]
+        if kind == 0:
+            offset = base + address
+            if chunks and chunks[-1][0] + len(chunks[-1][1]) == offset:
+                chunks[-1][1].extend(data)
+            else:
+                chunks.append((offset, data))
+        elif kind == 1:
+            break
+        elif kind == 2:
+            base = ((data[0] << 8) | data[1]) << 4
+        elif kind == 4:
+            base = ((data[0] << 8) | data[1]) << 16
+    return chunks
+
+class LoadedImage(object):
+    """The words or addresses of a loaded image, as a read-only sequence.
+
+    Nothing is worked out until it is asked for. Words are read from
+    the image rather than memory, so they are the words loaded.
+    """
+
+    def __init__(self, chunks, units, words=False, little=False):
+        self._chunks = chunks
+        self._units  = units
+        self._words  = words
+        self._little = little
+        self._counts = [(len(data) + units - 1) / units
+                        for (offset, data) in chunks]
+
+    def __len__(self):
+        return sum(self._counts)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = index + len(self)
+        for ((offset, data), count) in zip(self._chunks, self._counts):
+            if 0 <= index < count:
+                if not self._words:
+                    return offset + index * self._units
+                unit = bytearray(data[index * self._units:
+                                      (index + 1) * self._units])
+                unit.extend(bytearray(self._units - len(unit)))
+                if self._little:
+                    unit.reverse()
+                value = 0
+                for byte in unit:
+                    value = (value << 8) | byte
+                return value
+            index = index - count
+        raise IndexError('image index out of range')
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def index(self, value):
+        for (index, item) in enumerate(self):
+            if item == value:
+                return index
+        raise ValueError('{:} is not in image'.format(value))
+
+class Snapshot(object):
+    """The pages of a memory when a snapshot was taken."""
+    __slots__ = ('memory', 'pages')
+
+    def __init__(self, memory, pages):
+        self.memory = memory
+        self.pages  = pages
+
+class Mapping(object):
+    """A file mapped into memory from start to end."""
+    __slots__ = ('filename', 'mode', 'start', 'end', 'map')
+
+    def __init__(self, filename, mode, start, end):
+        self.filename = filename
+        self.mode     = mode
+        self.start    = start
+        self.end      = end
+        self.map      = None
+
+class MemoryView(Memory):
+    """A read-only view of memory at one version.
+
+    Reads see the memory as it was when the view was taken. Any attempt
+    to store raises a SegmentationFaultException.
+    """
+
+    def __init__(self, memory, shadow, version):
+        self._memory        = memory
+        self._view_shadow   = shadow
+        self.version        = version
+        self._address_space = memory._address_space
+        self._size          = memory._size
+        self._addressable   = memory._addressable
+        self._types         = memory._types
+        self._endian        = memory._endian
+        self._word_spacing  = memory._word_spacing
+        self._segment       = memory._segment
+        self._structs       = {}
+        # Views see all of memory, whatever the access.
+        self._access        = None
+
+    def _peek(self, offset):
+        shadow = self._view_shadow
+        while shadow is not None:
+            if offset in shadow.values:
+                return shadow.values[offset]
+            shadow = shadow.newer
+        return self._memory._peek(offset)
+
+    def _get_byte(self, offset):
+        if not self.in_range(offset):
+            raise SegmentationFaultException('{:} is out of bounds'
+                                 .format(hex(offset).replace('L','')))
+        return self._peek(offset)
+
+    def _set_byte(self, offset, value):
+        raise SegmentationFaultException('{:} is in a read-only view'
+                                 .format(hex(offset).replace('L','')))
+
+    def set_word(self, offset, value, size, aligned=True):
+        self._set_byte(offset, value)
+
+    def reset(self):
+        self._set_byte(0, 0)
+
+    def view(self):
+        return self
+
+    def add_write_observer(self, observer):
+        pass
+
+    def read_range(self, start, length, words=False):
+        count = length
+        if words:
+            length = length * self._word_spacing
+        self._check_range(start, length)
+        # Older records take precedence, so an offset is taken from the
+        # first record which has it.
+        older  = {}
+        end    = start + length
+        shadow = self._view_shadow
+        while shadow is not None:
+            values = shadow.values
+            if len(values) < length:
+                offsets = [offset for offset in values
+                           if start <= offset < end]
+            else:
+                offsets = [offset for offset in xrange(start, end)
+                           if offset in values]
+            for offset in offsets:
+                if offset not in older:
+                    older[offset] = values[offset]
+            shadow = shadow.newer
+        if len(older) == 0:
+            return self._memory.read_range(start, count, words)
+        data = self._memory._gather(start, length)
+        for (offset, value) in older.items():
+            data[offset - start] = value
+        data = memoryview(buffer(data))
+        if words:
+            return self._unpack(data, count)
+        return data
+
+    def get_values(self, offsets=None):
+        if offsets is None:
+            offsets = set(self._memory.get_values())
+            shadow  = self._view_shadow
+            while shadow is not None:
+                offsets.update(shadow.values)
+                shadow = shadow.newer
+        values = {}
+        for offset in offsets:
+            values[offset] = self._peek(offset)
+        return values
@@ -9,14 +9,90 @@
 #     2011-08-19 : Refactored fetch and decode.
 
 from Api        import RegisterReferenceException
-from Interface  import UpdateBroadcaster, LoggerClient
+from Interface  import UpdateBroadcaster, LoggerClient, Subscription
 from Logger     import CpuLogger
-from copy       import copy, deepcopy
+from collections import deque
 from System     import SystemCall
+from time       import time
 
 from Logger        import level
-from lib.Functions import binary as bin
-from lib.Functions import integer as int
+
+class UnknownEngineException(Exception):
+    pass
+
+class UnknownPipelineStageException(Exception):
+    pass
+
+class Slot(object):
+    """Holds an instruction and the data relating to it in one stage."""
+    __slots__ = ('valid', 'word', 'format', 'name', 'fields')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.valid  = False
+        self.word   = None
+        self.format = None
+        self.name   = None
+        self.fields = None
+
+class Pipeline(object):
+    """A fixed ring of slots, one for each pipeline stage.
+
+    Pushing an instruction moves every slot one stage along. The slot
+    leaving the last stage is reused for the new instruction, so nothing
+    is allocated once the pipeline is built. Stages without an
+    instruction hold invalid slots.
+    """
+    __slots__ = ('_slots', '_head', '_length')
+
+    def __init__(self, length):
+        self._length = length
+        self._slots  = tuple(Slot() for i in range(length))
+        self._head   = 0
+
+    def push(self, word):
+        """word:int -> slot:Slot
+
+        Puts an instruction in the first stage, retiring the one in the
+        last stage.
+        """
+        self._head = (self._head - 1) % self._length
+        slot = self._slots[self._head]
+        slot.clear()
+        slot.valid = True
+        slot.word  = word
+        return slot
+
+    def __getitem__(self, index):
+        return self._slots[(self._head + index) % self._length]
+
+    def __len__(self):
+        return self._length
+
+    def clear(self):
+        for slot in self._slots:
+            slot.clear()
+        self._head = 0
+
+    def save(self):
+        """Returns the contents of the slots, first stage first."""
+        return tuple((slot.valid, slot.word, slot.format, slot.name,
+                      slot.fields) for slot in
+                     [self[index] for index in range(self._length)])
+
+    def restore(self, saved):
+        """Puts back the contents of the slots returned by save."""
+        self._head = 0
+        for (slot, contents) in zip(self._slots, saved):
+            (slot.valid, slot.word, slot.format, slot.name,
+             slot.fields) = contents
+
+    def words(self):
+        """Returns the instructions in the pipeline, first stage first."""
+        return [slot.word for slot in
+                [self[index] for index in range(self._length)] if slot.valid]
 
 class BaseProcessor(UpdateBroadcaster, LoggerClient):
     def __init__(self, registers, memory, api, instructions):
@@ -39,6 +115,15 @@ class BaseProcessor(UpdateBroadcaster, LoggerClient):
     def get_pipeline_length(self):
         """Returns the number of stages in the pipeline."""
         pass
+    def snapshot(self):
+        """Returns the full state in the form of an update."""
+        pass
+    def checkpoint(self):
+        """Returns a checkpoint which rollback can return to."""
+        pass
+    def rollback(self, checkpoint):
+        """Returns the processor to the state of a checkpoint."""
+        pass
     def get_pc_value(self):
         """Returns the value of the program counter."""
         pass
@@ -74,6 +159,13 @@ class BaseProcessor(UpdateBroadcaster, LoggerClient):
 class Pipelined(BaseProcessor):
     """Pipelined CPU Implementation"""
 
+    # Stores larger than this many addressable units are not journalled;
+    # the next update sends the whole state instead.
+    _journal_limit = 4096
+    # Coordinators of stages which do nothing in this implementation.
+    _idle_coordinators = ('_memory_coordinator', '_accumilate_coordinator',
+                          '_writeback_coordinator')
+
     def __init__(self, pipeline, flags, **objects):
         # These are the objects which provide data for calculations.
         self._memory    = objects['memory'].get_memory()
@@ -81,6 +173,9 @@ class Pipelined(BaseProcessor):
         self._api       = objects['api'].get_api_reference(self)
         self._isa       = objects['instructions']
 
+        # Instruction descriptors with their API calls bound once, here.
+        self._instructions = self._isa.bind_descriptors(self._api)
+
         # System provides Signals
         self.system_call = SystemCall()
 
@@ -89,12 +184,23 @@ class Pipelined(BaseProcessor):
         self._pc         = self._registers.get_pc()
         self._word_space = self._memory.get_word_spacing()
 
-        # Pipeline is a stack for storing instructions and data relating
-        # to them.
-        self._pipeline        = []
+        # Pipeline holds a slot for each stage, storing instructions and
+        # data relating to them.
+        self._pipeline        = Pipeline(max(len(pipeline), 1))
         self._pipeline_stages = pipeline
         self._pipeline_flags  = flags
 
+        # The stages are bound to their coordinators once, here, with
+        # their positions in the pipeline. Stages which do nothing are
+        # left out.
+        self._stages = self.__compile_stages(pipeline)
+
+        # FI: fetch increments the IP, FD: fetch also decodes,
+        # EI: execute increments the IP.
+        self._fetch_increment   = 'FI' in flags
+        self._fetch_decode      = 'FD' in flags
+        self._execute_increment = 'EI' in flags
+
         # Special flags control some aspects of the processor's behaviour.
         self.__special_flags = {}
 
@@ -102,8 +208,25 @@ class Pipelined(BaseProcessor):
         self._breakpoints = []
         self._debug       = False
 
-        # This is a list of observers.
-        self.listeners = []
+        # This is a list of observers, with what each subscribed to.
+        self.listeners      = []
+        self._subscriptions = {}
+        self._memory_wanted    = False
+        self._registers_wanted = False
+
+        # Listeners are sent what changed since their last update. The
+        # journals collect register numbers and memory offsets as they
+        # are written. A store too large to journal, such as a reset,
+        # makes the next update a full one.
+        self._changed_registers = set()
+        self._changed_memory    = set()
+        self._changed_all       = False
+        self._registers.add_write_observer(self._changed_registers.add)
+        self._memory.add_write_observer(self._journal_memory)
+
+        # Tell the next broadcast how the cycle ended.
+        self._trapped = False
+        self._halted  = False
 
     def cycle(self):
 
@@ -114,39 +237,20 @@ class Pipelined(BaseProcessor):
         self.__special_flags['increment'] = False
 
         try:
-            for stage in self._pipeline_stages:
-                self._log.buffer(self, 'entering {0} stage'.format(stage),
-                                 level.FINEST)
-
-                # A little string transformation to help avoid accidents.
-                stagecall = '_' + stage + '_coordinator'
-
-                try:
-                # Dispatch to one of the instance's methods.
-                    call = getattr(self, stagecall)
-                    call(self._pipeline_stages.index(stage))
-                except AttributeError, e:
-                    self._log.buffer(self, 'no such pipeline stage: {:}'
-                                     .format(stage), level.ERROR)
-                    raise e
-                except ArithmeticError:
-                    self.system_call.service(16435935)
-                except RegisterReferenceException:
-                    self.system_call.service(16435936)
-                except IndexError, e:
-                # Routine, particularly for first cycles.
-                    self._log.buffer(self, '{0} found nothing in the pipeline'
-                                     .format(stage), level.FINEST)
-                self._log.buffer(self, 'leaving {0} stage'.format(stage),
-                                 level.FINEST)
+            try:
+                for (call, index) in self._stages:
+                    call(index)
+            except ArithmeticError:
+                self.system_call.service(16435935)
+            except RegisterReferenceException:
+                self.system_call.service(16435936)
         except Exception, e:
-            self.broadcast()
+            self._halted = True
             self._log.buffer(self, 'EXCEPTION {:}'.format(e.message), level.FINE)
             raise e
         finally:
+            # Listeners are updated as the cycle retires.
             self.__retire_cycle()
-        # Update listeners.
-        self.broadcast()
         self._log.buffer(self, 'completing a cycle', level.FINER)
 
 
@@ -154,38 +258,45 @@ class Pipelined(BaseProcessor):
 
         # Fetch an instruction.
         instruction = self.__fetch()
-        self._pipeline.insert(0, [instruction])
+        self._pipeline.push(instruction)
 
         ### Deal with Flags ###
         # FI denotes fetch-increment on the IP, meaning the IP is
         # updated at this stage in the cycle, rather than at the end.
-        if 'FI' in self._pipeline_flags:
+        if self._fetch_increment:
             self._registers.increment(self._pc, self._word_space)
             self.__special_flags['increment'] = True
         # If processor is meant to fetch and decode in one step...
-        if 'FD' in self._pipeline_flags:
+        if self._fetch_decode:
             self._decode_coordinator(index)
 
     def _decode_coordinator(self, index):
+        slot = self._pipeline[index]
+        if not slot.valid:
+            # Routine, particularly for first cycles.
+            return
         (format_type, name, number_of_parts) = self.__decode(index)
-        self._pipeline[index].append(format_type)
-        self._pipeline[index].append(name)
+        slot.format = format_type
+        slot.name   = name
         # TODO: Review - this stalls the pipeline. (2011-08-18)
         # If it is a multi-part instruction, get all of it.
         # TRY: raising index error and dealing with instruction
         # in cycle.
         while number_of_parts > 1:
             self._log.buffer(self, "multi-part instruction", level.FINEST)
-            instruction = self._pipeline[0][0]
+            instruction = self._pipeline[0].word
             part = self.__fetch()
             instruction = self.__concatenate_instruction(
                 instruction, part)
-            self._pipeline[0][0] = instruction
+            self._pipeline[0].word = instruction
             self._registers.increment(self._pc, self._word_space)
             number_of_parts = number_of_parts - 1
 
     def _execute_coordinator(self, index):
-        self.__execute(index)
+        slot = self._pipeline[index]
+        # Nothing to do until a decoded instruction reaches the stage.
+        if slot.valid and slot.name is not None:
+            self.__execute(index)
 
     def _memory_coordinator(self, index):
         pass
@@ -196,99 +307,62 @@ class Pipelined(BaseProcessor):
     def _writeback_coordinator(self, index):
         self.__writeback(index)
 
+    def __compile_stages(self, pipeline):
+        """pipeline:[str] -> ((call:method, index:int), ...):tuple
+
+        Raises:
+            UnknownPipelineStageException if a stage has no coordinator.
+        """
+        stages = []
+        for (index, stage) in enumerate(pipeline):
+            name = '_' + stage + '_coordinator'
+            call = getattr(self, name, None)
+            if call is None:
+                raise UnknownPipelineStageException(
+                    "no such pipeline stage: `{:}'".format(stage))
+            if (name in self._idle_coordinators
+                and call.im_func is getattr(Pipelined, name).im_func):
+                continue
+            stages.append((call, index))
+        return tuple(stages)
+
     def __concatenate_instruction(self, part_0, part_1):
-        part_0 = bin(part_0, self._size)
-        part_1 = bin(part_1, self._size)
         self._log.buffer(self, "concatenating {:} and {:}"
-                         .format(part_0[2:], part_1[2:]), level.FINEST)
-        instruction = part_0[2:] + part_1[2:]
-        return int(instruction, 2)
+                         .format(part_0, part_1), level.FINEST)
+        return (part_0 << self._size) | part_1
 
     def __fetch(self):
         instruction = self._memory.get_word(
-            self._registers.get_value(self._pc), self._size)
+            self._registers.get_value(self._pc), self._size, execute=True)
         return instruction
 
     def __decode(self, index):
-        # Data required to decode instruction
-        #Format-related data
-        bit_ranges  = self._isa.get_format_bit_ranges()
-        cycles      = self._isa.get_format_cycles()
-        # Instruction-related data
-        signatures  = self._isa.getSignatures()
-        mappings    = self._isa.get_instruction_to_format_map()
-
-        # Get the instruction to decode
-        instruction = bin(self._pipeline[index][0],self._size)[2:]
+        # The ISA compiles its signatures into a decode table when it
+        # is built. It tells us the instruction's format, signature and
+        # the number of parts it was broken into.
+        instruction = self._pipeline[index].word
         self._log.buffer(self, "decoding {0}".format(instruction), level.FINER)
-
-        # The following block identifies the instruction being decoded.
-        # It tells us the instruction's format, signature and the number
-        # of parts it was broken into.
-        test={}
-        # Test each type of instruction
-        for format_type in bit_ranges:
-            # against each of the relevant signatures.
-            for signature in signatures:
-                # Do no work at all if the instruction is obviously
-                # not a candidate.
-                if format_type in mappings[signature]:
-                    test.clear()
-
-                    # We might have to deal with a multi-field signature.
-                    for field in signatures[signature]:
-                        start= bit_ranges[format_type][field][0]
-                        end  = bit_ranges[format_type][field][1]+1
-                        test[field]=int(instruction[start:end],2)
-
-                    if test == signatures[signature]:
-                        number_of_parts = cycles[format_type]
-                        self._log.buffer(self, "decoded `{0}' type instruction, {1}"
-                                         .format(format_type, signature),
-                                         level.FINER)
-                        return (format_type, signature, number_of_parts)
+        decoded = self._isa.decode(instruction)
+        if decoded is not None:
+            self._log.buffer(self, "decoded `{0}' type instruction, {1}"
+                             .format(decoded[0], decoded[1]), level.FINER)
+        return decoded
 
     def __execute(self, index):
-        # A dict to hold the encoded instruction parts.
-        self._pipeline[index].append({})
-
-        # Data on the instruction format so we can decode properly.
-        format_sizes      = self._isa.get_format_sizes()
-        format_properties = self._isa.get_format_bit_ranges()
-
-        # Instruction data to operate on.
-        instruction_type   = self._pipeline[index][1]
-        instruction_name   = self._pipeline[index][2]
-
-        # Particularly in the case of multi-part instructions, we need
-        # to ensure the correct length binary is formed. We will use the
-        # format size property to achieve this.
-        size = format_sizes[instruction_type]
-        self._log.buffer(self, "reading {:}b {:} instruction"
-                         .format(size, instruction_name), level.FINER)
-
-        # Finally, translate the instruction into a binary representation.
-        instruction_binary = bin(self._pipeline[index][0], size)[2:]
-
-        # Begin the execution by decoding each bit-field.
-        for field in format_properties[instruction_type]:
-            start = format_properties[instruction_type][field][0]
-            end   = format_properties[instruction_type][field][1]+1
-            self._pipeline[index][3][field] = instruction_binary[start:end]
-            self._log.buffer(self, "`{:}' is {:} ({:})"
-                             .format(field,
-                                     instruction_binary[start:end],
-                                     int(instruction_binary[start:end], 2)),
-                             level.FINEST)
-
-        self._log.buffer(self, "executing {:} ({:})"
-                         .format(instruction_binary, instruction_name),
+        # The instruction's descriptor holds everything needed to run it,
+        # including the API calls already bound to our API.
+        slot = self._pipeline[index]
+        instruction = self._instructions[slot.name]
+
+        # Begin the execution by decoding each bit-field. The format's
+        # shifts and masks are applied to the integer instruction, which
+        # is sized by the format in the case of multi-part instructions.
+        fields = instruction.extract(slot.word)
+        slot.fields = fields
+        self._log.buffer(self, "executing {:} ({:}) with {:}"
+                         .format(slot.word, instruction.name, fields),
                          level.FINER)
 
-        # This next step deals with the actual state change[s] by making
-        # calls to the API.
-        implementation = self._isa.getImplementation()
-        name           = self._pipeline[index][2]
         # The branch offset is used to calculate the address of jump
         # instructions.
         branch_offset  = index
@@ -298,25 +372,19 @@ class Pipelined(BaseProcessor):
 
         # We also need to consider the number of fetch cycles that have
         # passed and add them to the offset calculation.
-        cycles = self._isa.get_format_cycles()[instruction_type] - 1
-        if cycles:
-            branch_offset = branch_offset + cycles
-        # If an API call returns false, the sequential flag will block
-        # the next call. This is used to evaluate tests.
+        branch_offset = branch_offset + instruction.cycles - 1
+
+        # This next step deals with the actual state change[s] by making
+        # calls to the API. If an API call returns false, the sequential
+        # flag will block the next call. This is used to evaluate tests.
         sequential = True
-        for method in implementation[name]:
+        for (call, args) in instruction.calls:
             if sequential:
-                call = getattr(self._api, method[0])
-                args = method[1]
-                self._log.buffer(self, "calling {0} with {1}"
-                                 .format(call.__name__, args), level.FINER)
-                sequential = call(args,
-                                  self._pipeline[index][3],
-                                  branch_offset=branch_offset)
+                sequential = call(args, fields, branch_offset=branch_offset)
             else:
                 self._log.buffer(self, 'skipping an API call', level.FINEST)
                 sequential = True
-        if 'EI' in self._pipeline_flags:
+        if self._execute_increment:
             self._registers.increment(self._pc, self._word_space)
             self.__special_flags['increment'] = True
 
@@ -324,12 +392,12 @@ class Pipelined(BaseProcessor):
         pass
 
     def __retire_cycle(self):
-        # Retire completed instructions.
-        if len(self._pipeline) > len(self._pipeline_stages):
-            self._pipeline.pop()
-        self.broadcast()
+        # Completed instructions retire as the pipeline moves on.
         # Cooperate with any debuggery.
-        if self._debug and self.get_pc_value() in self._breakpoints:
+        trapped = self._debug and self.get_pc_value() in self._breakpoints
+        self._trapped = self._trapped or trapped
+        self.broadcast()
+        if trapped:
             # Call for a SigTrap
             self.system_call.service(16435934)
 
@@ -337,14 +405,40 @@ class Pipelined(BaseProcessor):
         """Reset the processor to starting values."""
         self._log.buffer(self, 'RESET performing reset', level.FINE)
         self._log.buffer(self, 'resetting registers', level.FINE)
+        self._api.settle()
         self._registers.reset()
         self._memory.reset()
         self._log.buffer(self, 'clearing pipeline', level.FINE)
-        self._pipeline    = []
+        self._pipeline.clear()
         self._breakpoints = []
         self._log.buffer(self, 'RESET completed', level.FINE)
         self.broadcast()
 
+    def checkpoint(self):
+        """-> checkpoint:tuple
+
+        Returns the state of the processor, registers and memory, which
+        rollback can return to. Memory is shared with the checkpoint
+        until it is changed, so taking one is cheap.
+        """
+        self._api.settle()
+        return (self._registers.snapshot(), self._memory.snapshot(),
+                self._pipeline.save())
+
+    def rollback(self, checkpoint):
+        """checkpoint:tuple -> ...
+
+        Returns the processor, registers and memory to the state they
+        were in when the checkpoint was taken. Breakpoints are kept.
+        """
+        self._log.buffer(self, 'rolling back to checkpoint', level.FINE)
+        (registers, memory, pipeline) = checkpoint[:3]
+        self._api.settle()
+        self._registers.restore(registers)
+        self._memory.restore(memory)
+        self._pipeline.restore(pipeline)
+        self.broadcast()
+
     def add_break_point(self, offset):
         try:
             self._log.buffer(self, 'breakpoint at {:}'.format(hex(offset)),
@@ -375,7 +469,7 @@ class Pipelined(BaseProcessor):
         return self._memory
 
     def get_pipeline(self):
-        return [i[0] for i in self._pipeline]
+        return self._pipeline.words()
 
     def get_pipeline_length(self):
         return len(self._pipeline_stages)
@@ -389,27 +483,443 @@ class Pipelined(BaseProcessor):
     def broadcast(self):
         """Overrides broadcast in the base class.
 
-        Sends information about registers, memory and pipeline.
+        Sends each listener the topics it subscribed to, when its
+        subscription is due, as
+            update(registers={number:value},
+                   memory={offset:value},
+                   pipeline={slot:word},
+                   pc=int,
+                   full=bool,
+                   registers_view=RegistersView,
+                   memory_view=MemoryView)
+        Registers, memory and pipeline slots are those which changed
+        since the listener's last update. Pipeline slots which were
+        emptied are sent as None. When full is true the update holds the
+        whole state and replaces it. The views are read-only and
+        versioned: a listener may keep them to see the state as it was
+        at this update. Nothing is built for topics nobody wants.
+        """
+        trapped = self._trapped
+        halted  = self._halted
+        self._trapped = self._halted = False
+        if self.listeners:
+            # Bits the api has deferred are worked out before listeners
+            # read the registers.
+            if self._registers_wanted:
+                self._api.settle()
+            now   = time()
+            views = {}
+            for listener in self.listeners:
+                subscription = self._subscriptions[listener]
+                subscription.note(self._changed_registers,
+                                  self._changed_memory,
+                                  self._changed_all)
+                if subscription.due(now, trapped, halted):
+                    update = self._update(subscription, views)
+                    subscription.delivered(now)
+                    super(Pipelined, self).broadcast([listener], **update)
+        self._changed_registers.clear()
+        self._changed_memory.clear()
+        self._changed_all = False
+
+    def _update(self, subscription, views):
+        # Builds an update with the subscription's topics. Views are
+        # shared by every update of one broadcast.
+        full = subscription.full
+        update = {'full' : full}
+        if subscription.wants('registers'):
+            if full:
+                numbers = self._registers.keys()
+            else:
+                numbers = subscription.changed_registers
+            update['registers'] = dict(
+                (number, self._registers.get_value(number))
+                for number in numbers if subscription.wants_register(number))
+            if 'registers' not in views:
+                views['registers'] = self._registers.view()
+            update['registers_view'] = views['registers']
+        if subscription.wants('memory'):
+            if full:
+                values = self._memory.get_values()
+                if subscription.memory is not None:
+                    values = dict((offset, values[offset]) for offset in values
+                                  if subscription.wants_offset(offset))
+            else:
+                values = self._memory.get_values(subscription.changed_memory)
+            update['memory'] = values
+            if 'memory' not in views:
+                views['memory'] = self._memory.view()
+            update['memory_view'] = views['memory']
+        if subscription.wants('pipeline'):
+            pipeline = self.get_pipeline()
+            last     = subscription.pipeline
+            if full:
+                slots = dict(enumerate(pipeline))
+            else:
+                slots = {}
+                for i in range(max(len(pipeline), len(last))):
+                    if i >= len(pipeline):
+                        slots[i] = None
+                    elif i >= len(last) or pipeline[i] != last[i]:
+                        slots[i] = pipeline[i]
+            subscription.pipeline = pipeline
+            update['pipeline'] = slots
+        if subscription.wants('pc'):
+            update['pc'] = self.get_pc_value()
+        return update
+
+    def snapshot(self):
+        """Returns the full state in the form of an update.
+
+        Listeners may call this at any time; it doesn't disturb the
+        changes waiting for their next update.
+        """
+        self._api.settle()
+        return self._update(Subscription(), {})
+
+    def _journal_memory(self, offset, length):
+        if not self._memory_wanted:
+            return
+        if length > self._journal_limit:
+            self._changed_all = True
+        else:
+            self._changed_memory.update(range(offset, offset + length))
+
+    def register(self, listener, subscription=None):
+        """Overrides register in the base class.
+
+        The subscription says which topics the listener is sent and
+        when. By default it is sent everything, every cycle.
         """
-        registers = self.get_registers()
-        memory    = self.get_memory()
-        pipeline  = self.get_pipeline()
-        super(Pipelined, self).broadcast(
-            self.listeners,
-            registers=copy(registers),
-            memory=deepcopy(memory),
-            pipeline=deepcopy(pipeline))
-
-    def register(self, listener):
-        """Overrides register in the base class."""
+        if subscription is None:
+            subscription = Subscription()
         super(Pipelined, self).register(self.listeners, listener)
+        self._subscriptions[listener] = subscription
+        self._memory_wanted = self._memory_wanted or subscription.wants('memory')
+        self._registers_wanted = (self._registers_wanted
+                                  or subscription.wants('registers'))
         # Overcomes a potential problem where newly-registered
         # listeners try to query before they should and have
-        # to eat an eception by updating them early.
-        self.broadcast()
+        # to eat an eception by updating them early. Only the new
+        # listener gets the full state.
+        listener.update(**self._update(subscription, {}))
+        subscription.delivered(time())
 
     def remove(self, listener):
         super(Pipelined, self).remove(self.listeners, listener)
+        if listener in self._subscriptions:
+            del self._subscriptions[listener]
+        self._memory_wanted = len([s for s in self._subscriptions.values()
+                                   if s.wants('memory')]) > 0
+        self._registers_wanted = len([s for s in self._subscriptions.values()
+                                      if s.wants('registers')]) > 0
+
+class Functional(Pipelined):
+    """Functional CPU Implementation
+
+    Runs one whole instruction per cycle without shuffling a pipeline
+    through its stages. The architectural results are those of the
+    Pipelined cpu: instructions are still fetched `lag' cycles before
+    they execute, where lag is the position of the execute stage, so
+    delay slots and branch offsets are unchanged.
+
+    Pipelines which do not fetch, increment and decode in one step, or
+    which increment after execution, fall back to the Pipelined cycle.
+    """
+
+    def __init__(self, pipeline, flags, **objects):
+        super(Functional, self).__init__(pipeline, flags, **objects)
+
+        self._stepwise = (len(pipeline) > 0 and pipeline[0] == 'fetch'
+                          and 'execute' in pipeline
+                          and 'decode' not in pipeline
+                          and 'FI' in flags and 'FD' in flags
+                          and 'EI' not in flags)
+        if self._stepwise:
+            self._lag = pipeline.index('execute')
+
+        # Fetched instructions which have not yet executed, as tuples of
+        # the following address, the word and a closure to execute it.
+        self._queue = deque()
+
+    def open_log(self, logger):
+        super(Functional, self).open_log(logger)
+        if not self._stepwise:
+            self._log.buffer(self, "pipeline can't be stepped, using "
+                             "pipelined cycles", level.INFO)
+
+    def cycle(self):
+        if not self._stepwise:
+            return super(Functional, self).cycle()
+
+        self._log.buffer(self, 'beginning a cycle', level.FINER)
+        try:
+            try:
+                self._advance(self._registers.get_value(self._pc))
+            except ArithmeticError:
+                self.system_call.service(16435935)
+            except RegisterReferenceException:
+                self.system_call.service(16435936)
+        except Exception, e:
+            self._halted = True
+            self._log.buffer(self, 'EXCEPTION {:}'.format(e.message), level.FINE)
+            raise e
+        finally:
+            self.broadcast()
+        self._log.buffer(self, 'completing a cycle', level.FINER)
+
+    def _advance(self, address):
+        self._step(address)
+
+    def _step(self, address):
+        # Fetch and decode the way the Pipelined cpu would, then execute
+        # the instruction fetched `lag' steps ago.
+        word = self._memory.get_word(address, self._size, execute=True)
+        self._registers.set_value(self._pc, address + self._word_space)
+        (format_type, name, parts) = self._isa.decode(word)
+        while parts > 1:
+            word = ((word << self._size)
+                    | self._memory.get_word(self.get_pc_value(), self._size,
+                                            execute=True))
+            self._registers.increment(self._pc, self._word_space)
+            parts = parts - 1
+        self._queue.append((self.get_pc_value(), word,
+                            self._compile(self._instructions[name], word)))
+        if len(self._queue) > self._lag:
+            self._queue.popleft()[2]()
+        if self._debug:
+            self._trap()
+
+    def _trap(self):
+        if self.get_pc_value() in self._breakpoints:
+            self._trapped = True
+            # Call for a SigTrap
+            self.system_call.service(16435934)
+
+    def _compile(self, instruction, word):
+        # Returns a closure which executes the instruction. The branch
+        # offset is fixed by the pipeline: FI has always taken place.
+        fields = instruction.extract(word)
+        branch_offset = self._lag + instruction.cycles
+        calls = instruction.calls
+        if len(calls) == 1:
+            (call, args) = calls[0]
+            def execute():
+                call(args, fields, branch_offset=branch_offset)
+        else:
+            def execute():
+                sequential = True
+                for (call, args) in calls:
+                    if sequential:
+                        sequential = call(args, fields,
+                                          branch_offset=branch_offset)
+                    else:
+                        sequential = True
+        return execute
+
+    def reset(self):
+        """Reset the processor to starting values."""
+        self._queue.clear()
+        super(Functional, self).reset()
+
+    def checkpoint(self):
+        return super(Functional, self).checkpoint() + (tuple(self._queue),)
+
+    def rollback(self, checkpoint):
+        self._queue.clear()
+        self._queue.extend(checkpoint[3])
+        super(Functional, self).rollback(checkpoint)
+
+    def get_pipeline(self):
+        if not self._stepwise:
+            return super(Functional, self).get_pipeline()
+        return [step[1] for step in reversed(self._queue)]
+
+    def get_pipeline_length(self):
+        if not self._stepwise:
+            return super(Functional, self).get_pipeline_length()
+        return 1
+
+class Block(object):
+    """A run of translated instructions starting at one address.
+
+    Each step holds the address of the next fetch, the instruction word
+    and a closure which executes it. A block is marked stale when a
+    store lands in the memory it was translated from.
+    """
+    __slots__ = ('start', 'end', 'steps', 'stale')
+
+    def __init__(self, start, end, steps):
+        self.start = start
+        self.end   = end
+        self.steps = steps
+        self.stale = False
+
+class Threaded(Functional):
+    """Threaded-code CPU Implementation
+
+    Translates basic blocks of instructions into chains of closures the
+    first time they are reached and caches them by address, so hot code
+    runs without fetch or decode work. Each call to cycle runs the next
+    step of a block, with the timing of the Functional cpu, so clients
+    counting cycles see one instruction per cycle. Stores into
+    translated memory invalidate the blocks they touch.
+    """
+
+    # Instructions which end a block once their delay slots are fetched.
+    # Any other change of flow is caught as the block runs.
+    _control_methods = ('branchAbsolute', 'branchRelative', 'incrementPc',
+                        'systemCall')
+    # Longest run of instructions translated into one block.
+    _block_limit = 64
+
+    def __init__(self, pipeline, flags, **objects):
+        super(Threaded, self).__init__(pipeline, flags, **objects)
+
+        # Translated blocks by start address, and the blocks covering
+        # each translated address.
+        self._blocks   = {}
+        self._covering = {}
+        self._low  = None
+        self._high = None
+        # The address the next step of the running block fetches from,
+        # with the block and the index of that step.
+        self._resume = None
+
+        self._memory.add_write_observer(self._invalidate)
+
+    def _advance(self, address):
+        # Carry on through the block the last cycle ran from, unless
+        # control flow has left it or it has been written over.
+        resume = self._resume
+        if (resume is not None and resume[0] == address
+            and not resume[1].stale):
+            (block, index) = (resume[1], resume[2])
+        else:
+            block = self._blocks.get(address)
+            if block is None:
+                block = self._translate(address)
+            if block is None:
+                # Nothing could be translated here; let any error surface.
+                self._resume = None
+                self._step(address)
+                return
+            index = 0
+        step = block.steps[index]
+        self._registers.set_value(self._pc, step[0])
+        if index + 1 < len(block.steps):
+            self._resume = (step[0], block, index + 1)
+        else:
+            self._resume = None
+        queue = self._queue
+        queue.append(step)
+        if len(queue) > self._lag:
+            queue.popleft()[2]()
+        if self._debug:
+            self._trap()
+
+    def reset(self):
+        """Reset the processor to starting values."""
+        self._resume = None
+        super(Threaded, self).reset()
+
+    def rollback(self, checkpoint):
+        self._resume = None
+        super(Threaded, self).rollback(checkpoint)
+
+    def _translate(self, start):
+        """start:int -> Block
+
+        Translates instructions from start until a control instruction
+        and its delay slots have been fetched.
+
+        Returns:
+            None if the first instruction can't be translated.
+        """
+        steps     = []
+        address   = start
+        remaining = None
+        while len(steps) < self._block_limit and remaining != 0:
+            try:
+                word = self._memory.get_word(address, self._size,
+                                             execute=True)
+                decoded = self._isa.decode(word)
+                if decoded is None:
+                    break
+                (format_type, name, parts) = decoded
+                following = address + self._word_space
+                while parts > 1:
+                    word = ((word << self._size)
+                            | self._memory.get_word(following, self._size,
+                                                    execute=True))
+                    following = following + self._word_space
+                    parts = parts - 1
+            except Exception:
+                break
+            instruction = self._instructions[name]
+            steps.append((following, word,
+                          self._compile(instruction, word)))
+            if remaining is not None:
+                remaining = remaining - 1
+            elif [m for (m, a) in instruction.methods
+                  if m in self._control_methods]:
+                remaining = self._lag
+            address = following
+        if len(steps) == 0:
+            return None
+
+        block = Block(start, address, tuple(steps))
+        self._blocks[start] = block
+        for offset in range(start, address):
+            self._covering.setdefault(offset, []).append(block)
+        if self._low is None or start < self._low:
+            self._low = start
+        if self._high is None or address > self._high:
+            self._high = address
+        self._log.buffer(self, 'translated {:} instructions at {:}'
+                         .format(len(steps), hex(start)), level.FINER)
+        return block
+
+    def _invalidate(self, offset, length):
+        # Called by memory for every store.
+        if (self._low is None or offset >= self._high
+            or offset + length <= self._low):
+            return
+        if length > len(self._covering):
+            addresses = [a for a in self._covering
+                         if offset <= a < offset + length]
+        else:
+            addresses = range(offset, offset + length)
+        for address in addresses:
+            for block in self._covering.pop(address, ()):
+                if not block.stale:
+                    block.stale = True
+                    if self._blocks.get(block.start) is block:
+                        del self._blocks[block.start]
+                    self._log.buffer(self, 'invalidated block at {:}'
+                                     .format(hex(block.start)), level.FINER)
+        if len(self._covering) == 0:
+            self._low = self._high = None
+
+# Processors which core.Simulation can build, by name.
+engines = {'pipelined'  : Pipelined,
+           'functional' : Functional,
+           'threaded'   : Threaded}
+
+def get_engine(name):
+    """name:str -> class
+
+    Returns the processor class for an engine name.
+
+    Raises:
+        UnknownEngineException if there is no such engine.
+    """
+    try:
+        return engines[name]
+    except KeyError:
+        raise UnknownEngineException(
+            "no such engine `{:}', expected one of: {:}"
+            .format(name, ", ".join(sorted(engines))))
 
 # Colophon
 # The soundtrack to Processor is:
@@ -7,7 +7,7 @@
 # since          : 2011-07-11
 # last modified  : 2011-08-10
 
-from copy import deepcopy
+from weakref   import ref
 from Logger    import RegisterLogger
 from Logger    import level
 from Interface import LoggerClient
@@ -30,16 +30,35 @@ class Registers(BaseRegisters):
         registers.addRegister(number=0, value=2147483647, size=32,
                               profile='gp', privilege=True)
         registers.remove_register(0)
-    """
 
-    _registers    = {}
-    _registers_iv = {}
-    _name_number  = {}
-    _number_name  = {}
+    The registers are kept in lists indexed by register number, with
+    None for the value of any number which isn't a register. Values are
+    stored as they are given rather than wrapped to a register's mask,
+    as the api reads carries from results wider than the register.
+    """
 
     def __init__(self, log=None):
         if log != None:
             self.open_log(log)
+        #values, initial values, widths, masks for the widths,
+        #profiles and privileges, by register number
+        self._values     = []
+        self._initial    = []
+        self._sizes      = []
+        self._masks      = []
+        self._profiles   = []
+        self._privileges = []
+        #the numbers of the registers, lowest first, and of the first
+        #with the program counter profile
+        self._numbers = []
+        self._pc      = None
+        self._name_number  = {}
+        self._number_name  = {}
+        #callables told of every change
+        self._write_observers = []
+        #the newest view, which is frozen before the next change
+        self._version = 0
+        self._view    = None
 
     def __copy__(self):
         #
@@ -48,7 +67,16 @@ class Registers(BaseRegisters):
         # although problem wasn't obvious in use with cli client.
         #
         new = Registers()
-        new._registers = deepcopy(self._registers)
+        new._values     = list(self._values)
+        new._initial    = list(self._initial)
+        new._sizes      = list(self._sizes)
+        new._masks      = list(self._masks)
+        new._profiles   = list(self._profiles)
+        new._privileges = list(self._privileges)
+        new._numbers    = list(self._numbers)
+        new._pc         = self._pc
+        new._name_number = self._name_number
+        new._number_name = self._number_name
         return new
 
     def add_register(self, number, value, size, profile, privilege):
@@ -58,15 +86,36 @@ class Registers(BaseRegisters):
         Adds a register.
         """
 
-        self._registers[number] = {}
-        self._registers[number]['value']     = value
-        self._registers[number]['size']      = size
-        self._registers[number]['profile']   = profile
-        self._registers[number]['privilege'] = privilege
+        if number >= len(self._values):
+            missing = number + 1 - len(self._values)
+            for table in [self._values, self._initial, self._profiles,
+                          self._privileges]:
+                table.extend([None] * missing)
+            self._sizes.extend([0] * missing)
+            self._masks.extend([0] * missing)
+        elif self._values[number] is not None:
+            self.remove_register(number)
+        self._values[number]     = value
+        self._initial[number]    = value
+        self._sizes[number]      = size
+        self._masks[number]      = (1 << size) - 1
+        self._profiles[number]   = profile
+        self._privileges[number] = privilege
+        self._numbers.append(number)
+        self._numbers.sort()
+        self._find_pc()
         self.log.buffer('added register: {:>2} {:>12} {:} {:>3} {:}'
                         .format(number, value, size, profile, privilege),
                         level.FINEST)
-        self._registers_iv = deepcopy(self._registers)
+
+    def _find_pc(self):
+        # Caches the number of the first register with the program
+        # counter profile.
+        self._pc = None
+        for number in self._numbers:
+            if self._profiles[number] == 'pc':
+                self._pc = number
+                break
 
     def add_register_mapping(self, name, number):
         """(name:str, number:int) -> register{name:number}:dict
@@ -78,64 +127,153 @@ class Registers(BaseRegisters):
         self._name_number[name]   = number
         self._number_name[number] = name
 
+    def view(self):
+        """-> view:RegistersView
+
+        Returns a read-only view of the registers as they are now. The
+        values are only copied if they change while the view is held.
+        """
+        view = self._view and self._view()
+        if view is None:
+            view = RegistersView(self, self._version)
+            self._view = ref(view)
+        return view
+
+    def _release_view(self):
+        # Gives the newest view its own copy of the values before they
+        # change.
+        view = self._view()
+        self._view = None
+        if view is not None:
+            view._values = self.values()
+
+    def add_write_observer(self, observer):
+        """observer:callable -> ...
+
+        Registers a callable which is told the number of every register
+        that is set, as observer(number). A reset reports every register.
+        """
+        if observer not in self._write_observers:
+            self._write_observers.append(observer)
+
+    def remove_write_observer(self, observer):
+        """De-registers a write observer."""
+        if observer in self._write_observers:
+            self._write_observers.remove(observer)
+
     def remove_register(self, number):
         """Deletes a register."""
-        del self._registers[number]
+        if not self._has(number):
+            raise KeyError(number)
+        for table in [self._values, self._initial, self._profiles,
+                      self._privileges]:
+            table[number] = None
+        self._sizes[number] = 0
+        self._masks[number] = 0
+        self._numbers.remove(number)
+        self._find_pc()
+
+    def _has(self, number):
+        # True if there is a register with the number.
+        return (0 <= number < len(self._values)
+                and self._values[number] is not None)
 
     def set_value(self, number, value):
         """number:int -> ...
         Stores a value in a register.
         """
-        if number not in self.keys():
+        if not self._has(number):
             return
-        name = self._number_name[number]
-        self.log.buffer("setting {:} to {:}".format(name, hex(value, 8)),
-                        level.FINER)
-        self._registers[number]['value']=value
+        if self._logging(level.FINER):
+            self.log.buffer("setting {:} to {:}"
+                            .format(self._number_name[number], hex(value, 8)),
+                            level.FINER)
+        if self._view is not None:
+            self._release_view()
+        self._version = self._version + 1
+        self._values[number] = value
+        for observer in self._write_observers:
+            observer(number)
 
     def get_value(self, number):
         """Returns the value stored in a register."""
-        if number not in self.keys():
+        values = self._values
+        if 0 <= number < len(values):
             # TODO: Raise register reference exception? (2011-08-05)
-            return
-        return self._registers[number]['value']
+            return values[number]
 
     def get_size(self, number):
         """Returns the width of a register in bits."""
-        if number not in self.keys():
-            return 0
-        return self._registers[number]['size']
+        sizes = self._sizes
+        if 0 <= number < len(sizes):
+            return sizes[number]
+        return 0
+
+    def get_mask(self, number):
+        """Returns a mask of the bits in the width of a register."""
+        masks = self._masks
+        if 0 <= number < len(masks):
+            return masks[number]
+        return 0
 
     def increment(self, number, amount=1):
         """(number:int, amount=1:int) -> ...
         Increases the value in a register
         """
         name = self._number_name[number]
-        self.log.buffer("adding {:} to {:}".format(amount, name),
-                        level.FINEST)
-        value = self._registers[number]['value']+amount
+        if self._logging(level.FINEST):
+            self.log.buffer("adding {:} to {:}".format(amount, name),
+                            level.FINEST)
+        value = self._values[number]+amount
         self.set_value(number, value)
 
+    def _logging(self, logging):
+        # Messages are only formatted if the log would keep them.
+        return logging <= getattr(self.log, 'logging_level', level.NONE)
+
     def get_pc(self):
         """-> register:int
         Returns the number of the register with the program counter.
         """
-        return map(lambda x: x['profile'] == 'pc',
-                 self._registers.values()).index(True)
+        if self._pc is None:
+            raise ValueError('no register has the pc profile')
+        return self._pc
 
     def reset(self):
         """Resets all registers to beginning values"""
         self.log.buffer("clearing register values", level.FINER)
-        self._registers = deepcopy(self._registers_iv)
+        if self._view is not None:
+            self._release_view()
+        self._version = self._version + 1
+        self._values[:] = self._initial
+        for observer in self._write_observers:
+            for number in self._numbers:
+                observer(number)
+
+    def snapshot(self):
+        """-> snapshot:{number:int->value:int}:dict
+
+        Returns the values of the registers, which restore can return
+        to.
+        """
+        return self.values()
+
+    def restore(self, snapshot):
+        """snapshot:dict -> ...
+
+        Returns the registers to the values in a snapshot. Only those
+        which differ are set.
+        """
+        for (number, value) in snapshot.items():
+            if self._values[number] != value:
+                self.set_value(number, value)
 
     def keys(self):
-        return self._registers.keys()
+        return list(self._numbers)
 
     def values(self):
-        values={}
-        for register in self._registers:
-            values[register]=self._registers[register]['value']
-        return values
+        values = self._values
+        return dict([(number, values[number]) for number in self._numbers])
 
     def get_registers(self):
         """... -> registers:object
@@ -161,7 +299,50 @@ class Registers(BaseRegisters):
     def get_utilization(self):
         """Returns a ratio of registers used 0 ≤ n ≤ 1.0."""
         changed = 0
-        for n in self._registers:
-            if self._registers[n]['value'] != self._registers_iv[n]['value']:
+        for n in self._numbers:
+            if self._values[n] != self._initial[n]:
                 changed = changed + 1
         return changed
+
+
+class RegistersView(object):
+    """A read-only view of the registers at one version.
+
+    Reads go to the registers until they change, after which the view
+    holds a copy of the values it was taken with.
+    """
+    __slots__ = ('_source', '_values', 'version', '__weakref__')
+
+    def __init__(self, source, version):
+        self._source = source
+        self._values = None
+        self.version = version
+
+    def get_value(self, number):
+        """Returns the value stored in a register."""
+        if self._values is None:
+            return self._source.get_value(number)
+        return self._values.get(number)
+
+    def values(self):
+        if self._values is None:
+            return self._source.values()
+        return dict(self._values)
+
+    def keys(self):
+        return self._source.keys()
+
+    def get_size(self, number):
+        return self._source.get_size(number)
+
+    def get_mask(self, number):
+        return self._source.get_mask(number)
+
+    def get_pc(self):
+        return self._source.get_pc()
+
+    def get_register_mappings(self):
+        return self._source.get_register_mappings()
+
+    def get_number_name_mappings(self):
+        return self._source.get_number_name_mappings()
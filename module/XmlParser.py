@@ -28,15 +28,14 @@ class XmlDocument(object):
 
 class XmlReader(object):
     """Provides storage for derrived classes """
-    _data={}
-
-    def __del__(self):
-        self._data.clear()
+    def __init__(self):
+        self._data={}
 
 class InstructionReader(XmlReader):
     """A class to parse an instruction.xsd-validated isa specification"""
 
     def __init__(self, filename):
+        XmlReader.__init__(self)
         self._document=XmlDocument(filename + 'instructions.xml')
         self._root_node=self._document._root_node
         self._parse_root()
@@ -186,11 +185,9 @@ class MachineReader(XmlReader):
 
     _language=None
     _address_space=None
-    _memory={}
-    _registers={}
-    _register_mappings={}
 
     def __init__(self, filename):
+        XmlReader.__init__(self)
         self._document=XmlDocument(filename + 'machine.xml')
         self._root_node=self._document._root_node
         self._parse_root()
@@ -238,12 +235,36 @@ class MachineReader(XmlReader):
                 s_name  = asciify(segment.tagName)
                 s_start = int(asciify(segment.attributes['start'].value), 16)
                 s_end   = int(asciify(segment.attributes['end'].value), 16)
-                memory.append((s_name, s_start, s_end))
+                (s_file, s_mode) = self._parse_image(segment)
+                s_restricted = False
+                if segment.hasAttribute('restricted'):
+                    s_restricted = asciify(
+                        segment.attributes['restricted'].value) == 'True'
+                s_access = None
+                if segment.hasAttribute('access'):
+                    s_access = asciify(segment.attributes['access'].value)
+                memory.append((s_name, s_start, s_end, s_file, s_mode,
+                               s_restricted, s_access))
+            image = self._parse_image(memory_node)
         except Exception, e:
             raise XmlDataFormatException(e.message)
         # TODO: address space is currently hard-coded to begin at 0x00.
         # this is just a marker for future refactoring
         self._data['memory']=tuple(memory)
+        self._data['image']=image
+
+    def _parse_image(self, node):
+        """Returns the file named to back a memory or segment node and
+        its mode, or (None, None) if there isn't one.
+
+        Files are optional. The mode defaults to copy-on-write.
+        """
+        if not node.hasAttribute('file'):
+            return (None, None)
+        mode = 'copy-on-write'
+        if node.hasAttribute('mode'):
+            mode = asciify(node.attributes['mode'].value)
+        return (asciify(node.attributes['file'].value), mode)
 
     def _parse_registers(self):
         registers=[]
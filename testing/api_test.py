@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Api Tests.
+# file           : api_test.py
+# author         : Tom Regan <noreply.tom.regan@gmail.com>
+# since          : 2011-07-10
+# last modified  : 2011-08-19
+
+import unittest
+import sys
+from random import Random
+sys.path.append('../')
+
+import core
+
+from module import Api
+from module import Builder
+from module import Logger
+
+
+
+if __name__ == '__main__':
+
+    class TestApi(unittest.TestCase):
+
+        def setUp(self):
+            self.logger=Logger.Logger('logs/api_test.log')
+            self.logger.buffer('>-----setUp')
+
+        def tearDown(self):
+            self.logger.buffer('>-----tearDown')
+            self.logger.flush()
+
+        def make(self, config):
+            """Returns isa, registers and memory built from a config."""
+            coordinator = Builder.Coordinator()
+            objects = []
+            for builder in [Builder.InstructionBuilder(),
+                            Builder.RegisterBuilder(log=self.logger),
+                            Builder.MemoryBuilder(log=self.logger)]:
+                coordinator.set_builder(builder)
+                coordinator.make(filename=config)
+                objects.append(coordinator.get_object())
+            return objects
+
+        def execute(self, api, instruction, word, registers, memory):
+            """Runs an instruction's calls as the processor does,
+            returning what they returned and the state they left.
+            """
+            fields = instruction.extract(word)
+            results = []
+            sequential = True
+            try:
+                for (call, args) in instruction.calls:
+                    if sequential:
+                        sequential = call(args, fields, branch_offset=2)
+                    else:
+                        sequential = True
+                    results.append(sequential)
+            except Exception, e:
+                results.append(e.__class__)
+            api.settle()
+            return (results, registers.values(), memory.get_values())
+
+        def test_masked_sunray(self):
+            """MaskedSunray agrees with Sunray on every instruction."""
+            random = Random(2011)
+            for config in ['../config/mips32/', '../config/8085/']:
+                (isa, registers, memory) = self.make(config)
+                class Cpu(object):
+                    def get_registers(self):
+                        return registers
+                    def get_memory(self):
+                        return memory
+                apis = []
+                for api in [Api.Sunray(), Api.MaskedSunray()]:
+                    api.open_log(self.logger)
+                    api.get_api_reference(Cpu())
+                    apis.append((api, isa.bind_descriptors(api)))
+                for name in sorted(apis[0][1]):
+                    size = apis[0][1][name].size
+                    for i in range(200):
+                        for number in registers.keys():
+                            width = registers.get_size(number)
+                            registers.set_value(number, random.choice(
+                                [0, 1, (1 << width) - 1, 1 << (width - 1),
+                                 random.getrandbits(width)]))
+                        word = random.getrandbits(size)
+                        before = (registers.snapshot(), memory.snapshot())
+                        outcomes = []
+                        for (api, instructions) in apis:
+                            registers.restore(before[0])
+                            memory.restore(before[1])
+                            outcomes.append(self.execute(api,
+                                instructions[name], word, registers, memory))
+                        self.assertEquals(outcomes[0], outcomes[1],
+                                          '{:} {:}'.format(name, word))
+                memory.reset()
+
+        def test_deferred_flags(self):
+            """Flag bits set by a run of instructions are worked out when
+            the flags are next read, with the values they would have had
+            if set straight away.
+            """
+            random = Random(2011)
+            (isa, registers, memory) = self.make('../config/8085/')
+            class Cpu(object):
+                def get_registers(self):
+                    return registers
+                def get_memory(self):
+                    return memory
+            writes = []
+            registers.add_write_observer(writes.append)
+            for api in [Api.Sunray(), Api.MaskedSunray()]:
+                api.open_log(self.logger)
+                api.get_api_reference(Cpu())
+                instructions = isa.bind_descriptors(api)
+                # CPI, DCR and JNZ, which tests the zero flag.
+                words = [lambda: (int('0xfe', 16) << 8) | random.getrandbits(8),
+                         lambda: (random.getrandbits(3) << 3) | 5,
+                         lambda: (int('0xc2', 16) << 16) | 8]
+                for i in range(300):
+                    for number in registers.keys():
+                        width = registers.get_size(number)
+                        registers.set_value(number, random.choice(
+                            [0, 1, (1 << width) - 1, random.getrandbits(width)]))
+                    program = [random.choice(words)() for j in range(4)]
+                    before = registers.snapshot()
+                    outcomes = []
+                    for settled in [True, False]:
+                        registers.restore(before)
+                        del writes[:]
+                        results = []
+                        for word in program:
+                            first = word
+                            while first >> 8:
+                                first = first >> 8
+                            instruction = instructions[isa.decode(first)[1]]
+                            fields = instruction.extract(word)
+                            sequential = True
+                            for (call, args) in instruction.calls:
+                                if sequential:
+                                    sequential = call(args, fields,
+                                                      branch_offset=2)
+                                else:
+                                    sequential = True
+                                results.append(sequential)
+                                if settled:
+                                    api.settle()
+                        flags = writes.count(1)
+                        api.settle()
+                        outcomes.append((results, registers.values()))
+                    self.assertEquals(outcomes[0], outcomes[1],
+                                      '{:} {:}'.format(program, before))
+                    operands = ([(word >> 3) & 7 for word in program
+                                 if word >> 8 == 0]
+                                + [word & 255 for word in program
+                                   if word >> 8 == int('0xfe', 16)])
+                    if 1 not in operands:
+                        # Nothing but the flag tests read the flags.
+                        self.assertTrue(flags <= len(
+                            [word for word in program if word >> 16]))
+
+        def test_api_registry(self):
+            """Simulations use the api their ISA or caller names."""
+            simulation=core.Simulation(config='../config/8085/')
+            self.assertEquals('sunray', simulation.get_isa().get_api())
+            self.assertEquals(Api.Sunray, simulation.api.__class__)
+            Api.register_api('test', Api.MaskedSunray)
+            try:
+                simulation=core.Simulation(config='../config/8085/',
+                                           api='test')
+                self.assertEquals(Api.MaskedSunray,
+                                  simulation.api.__class__)
+            finally:
+                del Api.apis['test']
+            with self.assertRaises(Api.UnknownApiException):
+                core.Simulation(config='../config/8085/', api='test')
+
+    tests = unittest.TestLoader().loadTestsFromTestCase(TestApi)
+    unittest.TextTestRunner(verbosity=1).run(tests)
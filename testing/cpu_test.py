@@ -11,13 +11,16 @@ import unittest
 import sys
 sys.path.append('../')
 
+import core
+
 from module import Api
 from module import Builder
 from module import Assembler
 from module import Logger
 from module import Processor
 
-from module.System import SigTrap
+from module.System import SigTerm, SigTrap
+from module.Interface import Subscription, UnknownTopicException
 
 from module.lib.Functions import binary as bin
 
@@ -66,11 +69,37 @@ if __name__ == '__main__':
                 flags=pipeline[1])
             self.cpu.open_log(self.logger)
 
+            self.threaded = Processor.Threaded(
+                registers=self.registers, memory=self.memory,
+                api=self.api, instructions=self.instructions,
+                pipeline=pipeline[0],
+                flags=pipeline[1])
+            self.threaded.open_log(self.logger)
+
         def tearDown(self):
             self.memory.reset()
             self.logger.buffer('>-----tearDown')
             self.logger.flush()
 
+        def slots(self):
+            """Returns the valid pipeline slots as lists."""
+            pipeline = self.cpu._pipeline
+            return [[slot.word, slot.format, slot.name, slot.fields]
+                    for slot in [pipeline[i] for i in range(len(pipeline))]
+                    if slot.valid]
+
+        def test_pipeline_ring(self):
+            """Pipeline slots are reused as instructions retire."""
+            length = len(self.cpu._pipeline)
+            slots = [self.cpu._pipeline[i] for i in range(length)]
+            for i in range(length + 2):
+                self.cpu.cycle()
+            self.assertEquals(length, len(self.slots()))
+            for i in range(length):
+                self.assertEquals(True, self.cpu._pipeline[i] in slots)
+            self.cpu.reset()
+            self.assertEquals([], self.slots())
+
         def test_noop(self):
             self.logger.buffer('>-----testNoop/Fetch')
             pc=self.cpu._registers.get_value(33)
@@ -78,7 +107,7 @@ if __name__ == '__main__':
             for i in range(cycles):
                 self.cpu.cycle()
             self.assertEquals(pc+cycles*4, self.cpu._registers.get_value(33))
-            self.assertEquals([[0, 'j', 'nop']], self.cpu._pipeline)
+            self.assertEquals([[0, 'j', 'nop', None]], self.slots())
 
         def test_decode(self):
             self.logger.buffer('>-----testDecode')
@@ -87,11 +116,9 @@ if __name__ == '__main__':
             for i in range(cycles):
                 self.cpu.cycle()
             self.assertEquals(pc+cycles*4, self.cpu._registers.get_value(33))
-            self.assertEquals([[0, 'j', 'nop'],
-                               [0,'j','nop',{'im':
-                                              '00000000000000000000000000',
-                                              'op': '000000'}]],
-                              self.cpu._pipeline)
+            self.assertEquals([[0, 'j', 'nop', None],
+                               [0,'j','nop',{'im': 0, 'op': 0}]],
+                              self.slots())
 
         def test_execute(self):
             self.logger.buffer('>-----testExecute')
@@ -100,17 +127,41 @@ if __name__ == '__main__':
             for i in range(cycles):
                 self.cpu.cycle()
             self.assertEquals(pc+cycles*4, self.cpu._registers.get_value(33))
-            self.assertEquals([[0, 'j', 'nop'],
-                               [0,'j','nop',{'im':
-                                              '00000000000000000000000000',
-                                              'op': '000000'}],
-                               [0,'j','nop',{'im':
-                                              '00000000000000000000000000',
-                                              'op': '000000'}],
-                               [0,'j','nop',{'im':
-                                              '00000000000000000000000000',
-                                              'op': '000000'}]],
-                              self.cpu._pipeline)
+            self.assertEquals([[0, 'j', 'nop', None],
+                               [0,'j','nop',{'im': 0, 'op': 0}],
+                               [0,'j','nop',{'im': 0, 'op': 0}],
+                               [0,'j','nop',{'im': 0, 'op': 0}]],
+                              self.slots())
+
+        def test_decode_table(self):
+            """Compiled decode table identifies instructions."""
+            i=self.assembler.read_lines(['add  $t0, $t1, $t2\n',
+                                         'addi $s0, $zero, 32\n',
+                                         'nop'])
+            i=self.assembler.convert(i)
+            self.assertEquals(('r', 'add', 1), self.instructions.decode(i[0]))
+            self.assertEquals(('i', 'addi', 1), self.instructions.decode(i[1]))
+            self.assertEquals(('j', 'nop', 1), self.instructions.decode(i[2]))
+
+        def test_field_extraction(self):
+            """Fields are extracted as signed and unsigned integers."""
+            i=self.assembler.read_lines(['addi $s0, $t1, -2'])
+            i=self.assembler.convert(i)
+            fields = self.instructions.extract_fields('i', i[0])
+            self.assertEquals({'op': 8, 'rs': 9, 'rt': 16, 'im': 65534},
+                              fields)
+            self.assertEquals(-2, fields.signed['im'])
+            self.assertEquals(9, fields.signed['rs'])
+
+        def test_bound_descriptors(self):
+            """Instruction descriptors hold bound API calls."""
+            add = self.cpu._instructions['add']
+            self.assertEquals(('r', 32, 1), (add.format, add.size, add.cycles))
+            (call, args) = add.calls[0]
+            self.assertEquals(self.api.addRegisters, call)
+            self.assertEquals(('rd', 'rs', 'rt'), args)
+            # The ISA's own descriptors are left unbound.
+            self.assertEquals((), self.instructions.get_descriptors()['add'].calls)
 
         def test_pipeline(self):
             self.logger.buffer('>-----testPipeline')
@@ -167,5 +218,308 @@ if __name__ == '__main__':
             self.assertEquals("00000010001100101000000000101010",
                               bin(self.cpu.get_pipeline()[0], 32)[2:])
 
+        def test_broadcast_changes(self):
+            """Listeners are sent the full state, then what changed."""
+            updates=[]
+            class Listener(object):
+                def update(self, **kwargs):
+                    updates.append(kwargs)
+            program=self.assembler.read_lines(['addi $s1, $zero, 255'])
+            program=self.assembler.convert(program)
+            self.memory.load_text(program)
+            self.cpu.register(Listener())
+            self.assertEquals(True, updates[0]['full'])
+            self.assertEquals(4194304, updates[0]['registers'][33])
+            self.assertEquals(255, updates[0]['memory'][4194307])
+            cycles=2
+            for i in range(cycles):
+                self.cpu.cycle()
+            # One update per cycle.
+            self.assertEquals(cycles+1, len(updates))
+            self.assertEquals(False, updates[2]['full'])
+            self.assertEquals({33: 4194312, 17: 255}, updates[2]['registers'])
+            self.assertEquals({0: 0, 1: program[0]}, updates[2]['pipeline'])
+            self.assertEquals({}, updates[2]['memory'])
+            self.memory.set_word(int('0x10000000', 16), 1023, 32)
+            self.cpu.cycle()
+            self.assertEquals({268435456: 0, 268435457: 0,
+                               268435458: 3, 268435459: 255},
+                              updates[3]['memory'])
+            self.assertEquals(True, self.cpu.snapshot()['full'])
+
+        def test_subscription(self):
+            """Listeners get only their topics, when they are due."""
+            updates=[]
+            class Listener(object):
+                def update(self, **kwargs):
+                    updates.append(kwargs)
+            program=self.assembler.read_lines(['addi $s1, $zero, 255\n',
+                                                 'addi $s2, $zero, 1023'])
+            program=self.assembler.convert(program)
+            self.memory.load_text(program)
+            self.cpu.register(Listener(), Subscription(
+                topics=['pc', 'registers'], registers=[18], every=2))
+            self.assertEquals(['full', 'pc', 'registers', 'registers_view'],
+                              sorted(updates[0].keys()))
+            self.assertEquals({18: 0}, updates[0]['registers'])
+            cycles=4
+            for i in range(cycles):
+                self.cpu.cycle()
+            self.assertEquals(3, len(updates))
+            # Changes are carried to the next delivery.
+            self.assertEquals({18: 1023}, updates[2]['registers'])
+            self.assertEquals(4194320, updates[2]['pc'])
+
+        def test_subscription_on_breakpoint(self):
+            """Listeners may be updated only at breakpoints."""
+            updates=[]
+            class Listener(object):
+                def update(self, **kwargs):
+                    updates.append(kwargs)
+            self.cpu.register(Listener(), Subscription(topics=['pc'],
+                                                       on_breakpoint=True))
+            self.cpu.add_break_point(int('0x40000c', 16))
+            with self.assertRaises(SigTrap):
+                for i in range(10):
+                    self.cpu.cycle()
+            self.assertEquals(2, len(updates))
+            self.assertEquals(int('0x40000c', 16), updates[1]['pc'])
+            with self.assertRaises(UnknownTopicException):
+                Subscription(topics=['cache'])
+
+        def test_register_reset(self):
+            """Registers return to their initial values on reset."""
+            self.assertEquals(33, self.registers.get_pc())
+            self.assertEquals(range(36), self.registers.keys())
+            self.assertEquals(int('0xffffffff', 16),
+                              self.registers.get_mask(16))
+            self.registers.set_value(16, 7)
+            self.registers.increment(33, 4)
+            self.assertEquals(2, self.registers.get_utilization())
+            self.registers.reset()
+            self.assertEquals(0, self.registers.get_value(16))
+            self.assertEquals(4194304, self.registers.get_value(33))
+            self.assertEquals(0, self.registers.get_utilization())
+            self.assertEquals(None, self.registers.get_value(36))
+            self.registers.set_value(36, 7)
+            self.assertEquals(None, self.registers.get_value(36))
+
+        def test_register_view(self):
+            """Register views keep their values while registers change."""
+            view = self.registers.view()
+            self.assertEquals(view, self.registers.view())
+            self.cpu.cycle()
+            self.assertEquals(4194304, view.get_value(33))
+            self.assertEquals(4194308, self.registers.view().get_value(33))
+            self.assertEquals(True, view.version < self.registers.view().version)
+
+        def test_functional_instruction(self):
+            """Functional cpu executes an instruction per cycle."""
+            cpu = Processor.get_engine('functional')(
+                registers=self.registers, memory=self.memory,
+                api=self.api, instructions=self.instructions,
+                pipeline=['fetch', 'execute', 'memory', 'writeback'],
+                flags='FI FD')
+            cpu.open_log(self.logger)
+            i=self.assembler.read_lines(['addi $s1, $zero, 255\n',
+                                           'addi $s2, $zero, 1023\n',
+                                           'slt  $s0, $s1, $s2'])
+            i=self.assembler.convert(i)
+            self.memory.load_text(i)
+            self.assertEquals(1, cpu.get_pipeline_length())
+            cycles = 3
+            for i in range(cycles):
+                cpu.cycle()
+            # The slt instruction is fetched but not yet executed.
+            self.assertEquals(1023, self.registers.get_value(18))
+            self.assertEquals(0, self.registers.get_value(16))
+            cpu.cycle()
+            self.assertEquals(1, self.registers.get_value(16))
+
+        def test_compiled_stages(self):
+            """Stages are bound once and idle stages are dropped."""
+            self.assertEquals([(self.cpu._fetch_coordinator, 0),
+                               (self.cpu._execute_coordinator, 1)],
+                              list(self.cpu._stages))
+            with self.assertRaises(Processor.UnknownPipelineStageException):
+                Processor.Pipelined(
+                    registers=self.registers, memory=self.memory,
+                    api=self.api, instructions=self.instructions,
+                    pipeline=['fetch', 'execute', 'retire'], flags='FI FD')
+
+        def test_assembler_labels(self):
+            """Labels on lines of their own name the next instruction."""
+            i=self.assembler.read_lines(['Main:   # start\n',
+                                           '  addi $s1, $zero, 255\n',
+                                           'Loop:\n',
+                                           '\n',
+                                           '\tj\tLoop  # again\n',
+                                           'nop'])
+            self.assertEquals({'Main':0, 'Loop':1},
+                              self.assembler.get_jump_table())
+            self.assertEquals(['addi $s1, $zero, 255', 'j 0x00400004', 'nop'],
+                              self.assembler._program)
+            self.assertEquals(3, len(i))
+
+        def test_assembler_encoding(self):
+            """Instructions are encoded as integers, with a binary
+            listing for display.
+            """
+            i=self.assembler.read_lines(['addi $s0, $t1, -2\n',
+                                           'add  $t0, $t1, $t2'])
+            self.assertEquals([int('0x2130fffe', 16), int('0x012a4020', 16)],
+                              i)
+            self.assertEquals(i, self.assembler.convert(list(i)))
+            self.assertEquals(['00100001001100001111111111111110',
+                               '00000001001010100100000000100000'],
+                              self.assembler.listing(i))
+            self.assertEquals(i, self.assembler.convert(
+                self.assembler.listing(i)))
+
+        def test_assembler_field_range(self):
+            """Values which don't fit their field are refused."""
+            i=self.assembler.read_lines(['addi $s0, $t1, 65535\n',
+                                           'addi $s0, $t1, -32768'])
+            self.assertEquals([int('0x2130ffff', 16), int('0x21308000', 16)],
+                              i)
+            for value in ['70000', '-40000', '65536', '-32769']:
+                with self.assertRaises(Assembler.BadInstructionOrSyntax) as e:
+                    self.assembler.read_lines(['nop\n',
+                                               'addi $s0, $t1, ' + value])
+                self.assertTrue('line 2' in str(e.exception))
+
+        def test_unknown_engine(self):
+            """Asking for an unknown engine raises an exception."""
+            with self.assertRaises(Processor.UnknownEngineException):
+                Processor.get_engine('superscalar')
+
+        def test_threaded_block(self):
+            """Threaded cpu runs a cached block an instruction a cycle."""
+            i=self.assembler.read_lines(['Main: addi $s1, $zero, 255\n',
+                                           'addi $s2, $zero, 1023\n',
+                                           'slt  $s0, $s1, $s2\n',
+                                           'j    Main\n',
+                                           'nop'])
+            i=self.assembler.convert(i)
+            self.memory.load_text(i)
+            for cycle in range(5):
+                self.threaded.cycle()
+            self.assertEquals(255, self.registers.get_value(17))
+            self.assertEquals(1023, self.registers.get_value(18))
+            self.assertEquals(1, self.registers.get_value(16))
+            # The jump and its delay slot end the block.
+            self.assertEquals(int('0x400000', 16), self.threaded.get_pc_value())
+            self.assertEquals([0], self.threaded.get_pipeline())
+            self.assertEquals(5, len(self.threaded._blocks[int('0x400000', 16)]
+                                     .steps))
+
+        def test_threaded_invalidation(self):
+            """Stores into translated code invalidate the block."""
+            i=self.assembler.read_lines(['Main: addi $s1, $zero, 255\n',
+                                           'j    Main\n',
+                                           'nop'])
+            i=self.assembler.convert(i)
+            self.memory.load_text(i)
+            for cycle in range(3):
+                self.threaded.cycle()
+            self.assertEquals(255, self.registers.get_value(17))
+            i=self.assembler.read_lines(['addi $s1, $zero, 16'])
+            i=self.assembler.convert(i)
+            self.memory.set_word(int('0x400000', 16), i[0], 32)
+            for cycle in range(2):
+                self.threaded.cycle()
+            self.assertEquals(16, self.registers.get_value(17))
+
+        def test_threaded_break_point(self):
+            """Threaded cpu stops mid-block at a break point."""
+            i=self.assembler.read_lines(['addi $s1, $zero, 255\n',
+                                           'addi $s2, $zero, 1023\n',
+                                           'slt  $s0, $s1, $s2'])
+            i=self.assembler.convert(i)
+            self.memory.load_text(i)
+            self.threaded.add_break_point(int('0x40000c', 16))
+            self.threaded.cycle()
+            self.threaded.cycle()
+            with self.assertRaises(SigTrap):
+                self.threaded.cycle()
+            # The cycle which fetched slt executed the instruction before it.
+            self.assertEquals(1023, self.registers.get_value(18))
+            self.assertEquals(0, self.registers.get_value(16))
+            self.assertEquals("00000010001100101000000000101010",
+                              bin(self.threaded.get_pipeline()[0], 32)[2:])
+
+        def test_step_engines(self):
+            """Stepping completes one instruction on every engine."""
+            lines=['addi $s1, $s1, 1\n'] * 16
+            for engine in ['pipelined', 'functional', 'threaded']:
+                simulation=core.Simulation(config='../config/mips32/',
+                                           engine=engine)
+                client=core.TestListener(simulation)
+                simulation.connect(client)
+                program=simulation.assembler.read_lines(lines)
+                simulation.memory.load_text(
+                    simulation.assembler.convert(program))
+                # An instruction completes in a cycle on the functional
+                # and threaded cpus, and in a pass of the pipeline on the
+                # pipelined cpu, which fetches one each cycle.
+                fetched = 4 * simulation.cpu.get_pipeline_length()
+                for i in range(3):
+                    pc = simulation.cpu.get_pc_value()
+                    simulation.step(client=client)
+                    self.assertEquals(pc + fetched,
+                                      simulation.cpu.get_pc_value())
+
+        def test_checkpoint_rollback(self):
+            """Rolling back to a checkpoint replays the same cycles."""
+            program=self.assembler.read_lines(['addi $s1, $zero, 255\n',
+                                                 'addi $s2, $zero, 1023\n',
+                                                 'sw   $s2, 0($gp)\n',
+                                                 'slt  $s0, $s1, $s2\n',
+                                                 'addi $s1, $s1, 1'])
+            program=self.assembler.convert(program)
+            for engine in [self.cpu, self.threaded]:
+                engine.reset()
+                self.memory.load_text(program)
+                engine.cycle()
+                checkpoint = engine.checkpoint()
+                before = self.registers.values()
+                for i in range(4):
+                    engine.cycle()
+                after = (self.registers.values(), engine.get_pipeline(),
+                         self.memory.get_values())
+                engine.rollback(checkpoint)
+                self.assertEquals(before, self.registers.values())
+                for i in range(4):
+                    engine.cycle()
+                self.assertEquals(after, (self.registers.values(),
+                                          engine.get_pipeline(),
+                                          self.memory.get_values()))
+
+        def test_concurrent_simulations(self):
+            """Simulations in one process don't share state."""
+            programs=[('../config/mips32/', '../asm/mips/tests/add.asm'),
+                      ('../config/8085/', '../asm/8085/progs/program3.asm')]
+            alone=[self.simulationHelper([program])[0]
+                   for program in programs]
+            self.assertEquals(alone, self.simulationHelper(programs))
+
+        def simulationHelper(self, programs, cycles=60):
+            # Runs the programs a cycle each in turn.
+            simulations=[]
+            for (config, program) in programs:
+                simulation=core.Simulation(config=config)
+                client=core.TestListener(simulation)
+                simulation.connect(client)
+                simulation.load(program, client=client)
+                simulations.append((simulation, client))
+            for i in range(cycles):
+                for (simulation, client) in simulations:
+                    try:
+                        simulation.cycle(client=client)
+                    except SigTerm:
+                        pass
+            return [simulation.registers.values()
+                    for (simulation, client) in simulations]
+
     tests = unittest.TestLoader().loadTestsFromTestCase(TestCpu)
     unittest.TextTestRunner(verbosity=1).run(tests)
@@ -9,6 +9,7 @@
 
 import unittest
 import sys
+import tempfile
 sys.path.append('../')
 
 from module import Api
@@ -16,8 +17,9 @@ from module import Builder
 from module import Logger
 from module import Assembler
 from module import Processor
+from module import Memory
 from module.Memory import (AddressingError, AlignmentError,
-                           SegmentationFaultException)
+                           HexFormatException, SegmentationFaultException)
 
 
 
@@ -151,6 +153,319 @@ if __name__ == '__main__':
                 value=self.memory.get_word(offset+(i*4), 32)
                 self.assertEquals(program[i], value)
 
+        def testWriteObserver(self):
+            """Write observers are told of stores and resets"""
+            self.logger.buffer('>-----testWriteObserver')
+            stores=[]
+            observer=lambda offset, length: stores.append((offset, length))
+            self.memory.add_write_observer(observer)
+            offset=int('0x7ffffffc',16)
+            self.memory.set_word(offset, 1023, 32)
+            self.memory.set_word(offset, 255, 16)
+            self.assertEquals([(offset, 4), (offset, 2)], stores)
+            self.memory.remove_write_observer(observer)
+            self.memory.set_word(offset, 255, 32)
+            self.assertEquals(2, len(stores))
+
+        def testView(self):
+            """Views see memory as it was when they were taken"""
+            self.logger.buffer('>-----testView')
+            offset=int('0x7ffffffc',16)
+            self.memory.set_word(offset, 1023, 32)
+            first=self.memory.view()
+            self.memory.set_word(offset, 255, 32)
+            second=self.memory.view()
+            self.memory.set_word(offset, 7, 32)
+            self.assertEquals(1023, first.get_word(offset, 32))
+            self.assertEquals(255, second.get_word(offset, 32))
+            self.assertEquals(7, self.memory.get_word(offset, 32))
+            self.assertEquals(True, first.version < second.version)
+            self.memory.reset()
+            self.assertEquals(1023, first.get_word(offset, 32))
+            self.assertEquals(0, self.memory.get_word(offset, 32))
+            with self.assertRaises(SegmentationFaultException):
+                first.set_word(offset, 0, 32)
+
+        def testViewRelease(self):
+            """Stores don't save values once views are released"""
+            self.logger.buffer('>-----testViewRelease')
+            offset=int('0x7ffffffc',16)
+            view=self.memory.view()
+            self.memory.set_word(offset, 1023, 32)
+            self.assertEquals(4, len(view._view_shadow.values))
+            del view
+            self.memory.set_word(offset, 255, 32)
+            self.assertEquals(None, self.memory._live_shadow())
+
+        def testPagesAllocatedOnWrite(self):
+            """Reads don't allocate memory; writes allocate one page"""
+            self.logger.buffer('>-----testPagesAllocatedOnWrite')
+            offset=int('0x7ffffffc',16)
+            self.assertEquals(0, self.memory.get_word(offset, 32))
+            self.assertEquals(0, len(self.memory._pages))
+            self.memory.set_word(offset, 1023, 32)
+            self.assertEquals(1, len(self.memory._pages))
+            self.assertEquals({offset+2: 3, offset+3: 255},
+                              self.memory.get_values())
+
+        def testDenseMemory(self):
+            """Small address spaces have their pages allocated up front"""
+            self.logger.buffer('>-----testDenseMemory')
+            memory=Memory.Memory([int('0xffff',16), 16, 16])
+            self.assertEquals(range(16), sorted(memory._pages.keys()))
+            memory.set_word(int('0xfffe',16), 65535, 16)
+            self.assertEquals(65535, memory.get_word(int('0xfffe',16), 16))
+            memory.reset()
+            self.assertEquals(0, memory.get_word(int('0xfffe',16), 16))
+            self.assertEquals(range(16), sorted(memory._pages.keys()))
+
+        def testLittleEndian(self):
+            """Little-endian words store the low byte at the lowest offset"""
+            self.logger.buffer('>-----testLittleEndian')
+            memory=Memory.Memory([int('0xffff',16), 32, 8], endian='Little')
+            memory.set_word(8, int('0x11223344',16), 32)
+            self.assertEquals({8: 0x44, 9: 0x33, 10: 0x22, 11: 0x11},
+                              memory.get_values())
+            self.assertEquals(int('0x11223344',16), memory.get_word(8, 32))
+            self.assertEquals(int('0x3344',16), memory.get_word(8, 16))
+            self.assertEquals(int('0x2233',16),
+                              memory.get_word(9, 16, aligned=False))
+
+        def testSlowPathAgrees(self):
+            """Unaligned and aligned stores lay out words alike"""
+            self.logger.buffer('>-----testSlowPathAgrees')
+            self.memory.set_word(4, -2, 32)
+            self.memory.set_word(9, int('0xdeadbeef',16), 32, aligned=False)
+            self.assertEquals(int('0xfffffffe',16),
+                              self.memory.get_word(4, 32))
+            self.assertEquals(int('0xdeadbe',16),
+                              self.memory.get_word(8, 32))
+            self.assertEquals(int('0xdeadbeef',16),
+                              self.memory.get_word(9, 32, aligned=False))
+
+        def imageHelper(self, data):
+            image=tempfile.NamedTemporaryFile()
+            image.write(data)
+            image.flush()
+            #kept open until memory is reset in tearDown
+            self.image=image
+            return image
+
+        def testMapFile(self):
+            """Mapped files are read in place and restored by a reset"""
+            self.logger.buffer('>-----testMapFile')
+            image=self.imageHelper('\x11\x22\x33\x44' * 3)
+            memory=Memory.Memory([int('0xffff',16), 32, 8])
+            memory.set_word(0x100, 7, 32)
+            view=memory.view()
+            memory.map_file(image.name, 0x102, 0x109)
+            self.assertEquals(int('0x00001122',16), memory.get_word(0x100, 32))
+            self.assertEquals(int('0x33441122',16), memory.get_word(0x104, 32))
+            self.assertEquals(int('0x33440000',16), memory.get_word(0x108, 32))
+            self.assertEquals(7, view.get_word(0x100, 32))
+            memory.set_word(0x104, 0, 32)
+            image.seek(0)
+            self.assertEquals('\x11\x22\x33\x44' * 3, image.read())
+            memory.reset()
+            self.assertEquals(int('0x33441122',16), memory.get_word(0x104, 32))
+            self.assertEquals(0, memory.get_word(0x100, 16))
+
+        def testMapFileReadOnly(self):
+            """Stores to a read-only mapping raise exception"""
+            self.logger.buffer('>-----testMapFileReadOnly')
+            image=self.imageHelper('\xff' * 8192)
+            offset=int('0x10000000',16)
+            self.memory.map_file(image.name, offset, mode='read-only')
+            self.assertEquals(int('0xffffffff',16),
+                              self.memory.get_word(offset + 4096, 32))
+            with self.assertRaises(SegmentationFaultException):
+                self.memory.set_word(offset + 4096, 0, 32)
+            with self.assertRaises(SegmentationFaultException):
+                self.memory.set_word(offset + 8190, 0, 32, aligned=False)
+            self.memory.set_word(offset + 8192, 1, 32)
+
+        def testMapFileShared(self):
+            """Stores to a shared mapping reach the file"""
+            self.logger.buffer('>-----testMapFileShared')
+            image=self.imageHelper('\x00' * 4100)
+            offset=int('0x10000000',16)
+            self.memory.map_file(image.name, offset, mode='shared')
+            self.memory.set_word(offset, int('0xdeadbeef',16), 32)
+            self.memory.set_word(offset + 4096, int('0x01020304',16), 32)
+            self.memory.sync()
+            image.seek(0)
+            data=image.read()
+            self.assertEquals('\xde\xad\xbe\xef', data[0:4])
+            self.assertEquals('\x01\x02\x03\x04', data[4096:4100])
+
+
+        def testSnapshot(self):
+            """Restoring a snapshot replaces only the pages changed"""
+            self.logger.buffer('>-----testSnapshot')
+            offset=int('0x10000000',16)
+            self.memory.set_word(offset, 1023, 32)
+            self.memory.set_word(offset + 4096, 7, 32)
+            snapshot=self.memory.snapshot()
+            self.memory.set_word(offset, 255, 32)
+            self.memory.set_word(offset + 8192, 1, 32)
+            view=self.memory.view()
+            pages=self.memory._pages
+            number=(offset + 4096) >> self.memory._page_bits
+            self.assertEquals(True, pages[number] is snapshot.pages[number])
+            number=offset >> self.memory._page_bits
+            self.assertEquals(False, pages[number] is snapshot.pages[number])
+            for i in range(2):
+                self.memory.restore(snapshot)
+                self.assertEquals(1023, self.memory.get_word(offset, 32))
+                self.assertEquals(0, self.memory.get_word(offset + 8192, 32))
+                self.memory.set_word(offset, 0, 32)
+            self.assertEquals(255, view.get_word(offset, 32))
+            self.assertEquals(1, view.get_word(offset + 8192, 32))
+
+        def testDenseSnapshot(self):
+            """Snapshots of small address spaces copy only pages stored to"""
+            self.logger.buffer('>-----testDenseSnapshot')
+            memory=Memory.Memory([int('0xffff',16), 32, 8])
+            memory.set_word(16, 1023, 32)
+            snapshot=memory.snapshot()
+            pages=dict(memory._pages)
+            memory.set_word(16, 255, 32)
+            memory.set_word(8192, 1, 32)
+            changed=[number for number in pages
+                     if memory._pages[number] is not pages[number]]
+            self.assertEquals([0, 2], sorted(changed))
+            stores=[]
+            memory.add_write_observer(
+                lambda offset, length: stores.append((offset, length)))
+            memory.restore(snapshot)
+            self.assertEquals([(0, 4096), (8192, 4096)], sorted(stores))
+            self.assertEquals(1023, memory.get_word(16, 32))
+            self.assertEquals(0, memory.get_word(8192, 32))
+            # A file mapped over the pages still leaves the snapshot
+            # restorable.
+            memory.set_word(8192, 1, 32)
+            image=tempfile.NamedTemporaryFile()
+            image.write('\x01\x02\x03\x04')
+            image.flush()
+            memory.map_file(image.name, 4096)
+            memory.restore(snapshot)
+            self.assertEquals(1023, memory.get_word(16, 32))
+            self.assertEquals(0, memory.get_word(8192, 32))
+            self.assertEquals(0, memory.get_word(4096, 32))
+
+        def testLoadImage(self):
+            """Loading an image stores it at the start of text"""
+            self.logger.buffer('>-----testLoadImage')
+            stores=[]
+            self.memory.add_write_observer(
+                lambda offset, length: stores.append((offset, length)))
+            offset=self.memory.get_start('text')
+            (binary, address)=self.memory.load_image(
+                '\x00\x00\x00\xff' + '\x00' * 4092 + '\x12\x34\x56\x78\x9a')
+            self.assertEquals([(offset, 4101)], stores)
+            self.assertEquals(1026, len(binary))
+            self.assertEquals([255, 0], list(binary)[:2])
+            self.assertEquals([int('0x12345678',16), int('0x9a000000',16)],
+                              [binary[-2], binary[-1]])
+            self.assertEquals(offset + 4100, address[-1])
+            for i in [0, 1024, 1025]:
+                self.assertEquals(binary[i], self.memory.get_word(address[i], 32))
+            with self.assertRaises(SegmentationFaultException):
+                self.memory.load_image('\xff', 0)
+
+        def testLoadHex(self):
+            """Loading Intel HEX stores records at their offsets"""
+            self.logger.buffer('>-----testLoadHex')
+            image=self.imageHelper(':020000040040BA\n'
+                                   ':0400000001020304F2\n'
+                                   ':0400040005060708DE\n'
+                                   ':00000001FF\n')
+            (binary, address)=self.memory.load_hex(image.name)
+            self.assertEquals([int('0x01020304',16), int('0x05060708',16)],
+                              list(binary))
+            self.assertEquals([int('0x400000',16), int('0x400004',16)],
+                              list(address))
+            self.assertEquals(int('0x05060708',16),
+                              self.memory.get_word(int('0x400004',16), 32))
+            image=self.imageHelper(':0400000001020304F3\n')
+            with self.assertRaises(HexFormatException):
+                self.memory.load_hex(image.name)
+
+        def testReadRange(self):
+            """Ranges are read whole and keep the values read"""
+            self.logger.buffer('>-----testReadRange')
+            offset=int('0x10000ffc',16)
+            self.memory.set_word(offset, 1023, 32)
+            self.memory.set_word(offset + 4, 255, 32)
+            inside=self.memory.read_range(offset, 4)
+            across=self.memory.read_range(offset, 8)
+            view=self.memory.view()
+            #a range in one page is the page itself until it is stored to
+            number=offset >> self.memory._page_bits
+            page=self.memory._pages[number]
+            self.assertEquals(True, number in self.memory._snapped)
+            self.memory.set_word(offset, 7, 32)
+            self.assertEquals(False, page is self.memory._pages[number])
+            self.assertEquals('\x00\x00\x00\xff',
+                              view.read_range(offset + 4, 4).tobytes())
+            self.assertEquals('\x00\x00\x03\xff', inside.tobytes())
+            self.assertEquals('\x00\x00\x03\xff\x00\x00\x00\xff',
+                              across.tobytes())
+            self.assertEquals([1023, 255],
+                              [int(word) for word in
+                               view.read_range(offset, 2, words=True)])
+            self.assertEquals([7, 255, 0],
+                              [int(word) for word in
+                               self.memory.read_range(offset, 3, words=True)])
+            self.assertEquals({offset: 7, offset + 4: 255},
+                              self.memory.get_slice(2, offset + 4))
+            with self.assertRaises(SegmentationFaultException):
+                self.memory.read_range(int('0x7ffffffc',16), 2, words=True)
+
+        def testRestrictedSegments(self):
+            """Restricted segments only allow their access"""
+            self.logger.buffer('>-----testRestrictedSegments')
+            memory=Memory.Memory([int('0x7fffffff',16), 32, 8])
+            memory.add_segment('text', int('0x400000',16),
+                               int('0x10000000',16), restricted=True)
+            memory.add_segment('data', int('0x10000000',16),
+                               int('0x7fffffff',16), restricted=True)
+            memory.load_text([255, 1023])
+            offset=int('0x400004',16)
+            self.assertEquals(1023, memory.get_word(offset, 32, execute=True))
+            with self.assertRaises(SegmentationFaultException):
+                memory.set_word(offset, 0, 32)
+            offset=int('0x10000000',16)
+            memory.set_word(offset, 7, 32)
+            with self.assertRaises(SegmentationFaultException):
+                memory.set_word(offset - 2, 7, 32, aligned=False)
+            with self.assertRaises(SegmentationFaultException):
+                memory.get_word(offset + 4, 32, execute=True)
+            memory.set_word(16, 7, 32)
+            self.assertEquals(7, memory.get_word(16, 32, execute=True))
+
+        def testDirtyPages(self):
+            """Stores mark their pages dirty until clear_dirty"""
+            self.logger.buffer('>-----testDirtyPages')
+            for space in [int('0xffff',16), int('0x7fffffff',16)]:
+                memory=Memory.Memory([space, 32, 8])
+                page=memory.get_page_size()
+                self.assertEquals([], memory.dirty_pages())
+                memory.set_word(page * 3 + 4, 1, 32)
+                memory.set_word(page * 5 - 2, 0x01010101, 32, aligned=False)
+                self.assertEquals([page * 3, page * 4, page * 5],
+                                  memory.dirty_pages())
+                memory.clear_dirty()
+                self.assertEquals([], memory.dirty_pages())
+                snapshot=memory.snapshot()
+                memory.set_word(page, 1, 32)
+                memory.clear_dirty()
+                memory.restore(snapshot)
+                self.assertEquals([page], memory.dirty_pages())
+                memory.clear_dirty()
+                memory.reset()
+                self.assertEquals([page * 3, page * 4, page * 5],
+                                  memory.dirty_pages())
 
     tests = unittest.TestLoader().loadTestsFromTestCase(TestMemory)
     unittest.TextTestRunner(verbosity=1).run(tests)